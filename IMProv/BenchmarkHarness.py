@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+_BenchmarkHarness_
+
+Harness shared by the IMProv and TrivialFileCatalog benchmarks, which
+only define their own measurements:
+
+- benchmarkParser, the command line options common to the benchmarks
+- inChild, to run a measurement in a forked process and report its
+  peak resident memory
+- median, percentiles and timeRepeated, to time measurements
+- runBenchmark, to run the measurements in a temporary directory and
+  print (or write to --output) the report as JSON, so that runs on
+  different revisions can be compared
+
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+from optparse import OptionParser
+
+
+def benchmarkParser(repeat, repeatHelp):
+    """
+    _benchmarkParser_
+
+    Return an OptionParser with the options common to the benchmarks,
+    --repeat defaulting to repeat and described by repeatHelp, for
+    the benchmark to add its own options to
+
+    """
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option("--repeat", type = "int", default = repeat,
+                      help = repeatHelp)
+    parser.add_option("--seed", type = "int", default = 12345,
+                      help = "random seed for the generated input")
+    parser.add_option("--label", default = None,
+                      help = "label for the run, such as the revision")
+    parser.add_option("--output", default = None,
+                      help = "JSON output file, default is stdout")
+    return parser
+
+
+def median(timings):
+    """
+    _median_
+
+    Median of a list of timings
+
+    """
+    timings = sorted(timings)
+    return timings[len(timings) // 2]
+
+
+def percentiles(values, points = (50, 90, 99, 99.9)):
+    """
+    _percentiles_
+
+    Return a dictionary of pN : value for the sorted list of values
+
+    """
+    result = {}
+    for point in points:
+        index = min(len(values) - 1, int(len(values) * point / 100.0))
+        result["p%s" % point] = values[index]
+    result["max"] = values[-1]
+    return result
+
+
+def timeRepeated(function, repeat):
+    """
+    _timeRepeated_
+
+    Time function() repeat times, returning the median time in seconds
+    and the result of the last call
+
+    """
+    timings = []
+    result = None
+    for count in range(repeat):
+        result = None
+        start = time.time()
+        result = function()
+        timings.append(time.time() - start)
+    return {"seconds" : median(timings), "runs" : repeat}, result
+
+
+def inChild(function, *args):
+    """
+    _inChild_
+
+    Run function(*args) in a forked process, returning its (JSON
+    serialisable) result with the peak resident memory of the process
+    added as maxRSSKilobytes
+
+    """
+    readEnd, writeEnd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readEnd)
+        status = 0
+        try:
+            try:
+                output = json.dumps(function(*args))
+            except Exception, ex:
+                output = json.dumps({"error" : str(ex)})
+                status = 1
+            handle = os.fdopen(writeEnd, 'w')
+            handle.write(output)
+            handle.close()
+        finally:
+            os._exit(status)
+    os.close(writeEnd)
+    handle = os.fdopen(readEnd)
+    output = handle.read()
+    handle.close()
+    usage = os.wait4(pid, 0)[2]
+    result = json.loads(output)
+    result["maxRSSKilobytes"] = usage.ru_maxrss
+    return result
+
+
+def idle():
+    """
+    _idle_
+
+    Baseline measurement of an idle child process
+
+    """
+    return {}
+
+
+def runBenchmark(options, prefix, benchmark):
+    """
+    _runBenchmark_
+
+    Run benchmark(options, workDir) in a temporary directory named
+    after prefix, and print the report, or write it to options.output.
+
+    benchmark returns the dictionary of its measurements, to which the
+    label, python version and baseline measurement of an idle child
+    are added. Returns the exit status of the benchmark
+
+    """
+    report = {
+        "label" : options.label,
+        "python" : sys.version.split()[0],
+        "baseline" : inChild(idle),
+        }
+    workDir = tempfile.mkdtemp(prefix = prefix)
+    try:
+        report.update(benchmark(options, workDir))
+    finally:
+        shutil.rmtree(workDir, True)
+
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    if options.output:
+        handle = open(options.output, 'w')
+        handle.write(output)
+        handle.close()
+    else:
+        print output
+    return 0
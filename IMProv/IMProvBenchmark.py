@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+_IMProvBenchmark_
+
+Benchmarks for parsing, querying and serialising IMProv documents.
+
+Generates a synthetic XML document made of the requested number of
+records, each a tree of the requested depth and fan-out whose nodes
+have attributes and whose leaves have text, then measures:
+
+- loadIMProvFile, loadIMProvString, and the compact and expat loaders
+- IMProvQuery with and without predicates, relative and absolute
+- processNodes over the whole tree
+- makeDOMElement().toprettyxml() and __str__
+- loading --files smaller documents one after another, and with
+  IMProvBulkLoader with each number of processes of --processes and
+  with the default choice, sending back either query results or the
+  whole trees
+- memory: peak resident memory of each measurement
+
+Each measurement runs in a forked process so that the memory figures
+are not polluted by the other measurements; the loadedDocument entry
+gives the memory of a process that only loaded the document.
+Timings are the median of --repeat runs, the report is printed as
+JSON, see BenchmarkHarness.
+
+Usage:
+
+    python IMProvBenchmark.py --records=2000 --depth=3 --fanout=4 --output=run.json
+
+"""
+
+import os
+import sys
+import random
+
+#from IMProv.IMProvLoader import loadIMProvFile, loadIMProvString
+#from IMProv.IMProvExpatLoader import fastLoadIMProvFile
+#from IMProv.IMProvQuery import IMProvQuery, compileQuery
+#from IMProv.IMProvBulkLoader import loadIMProvFiles, _defaultProcesses
+#from IMProv.BenchmarkHarness import benchmarkParser, inChild, timeRepeated, runBenchmark
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvLoader import loadIMProvFile, loadIMProvString
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvExpatLoader import fastLoadIMProvFile
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvQuery import IMProvQuery, compileQuery
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvBulkLoader import loadIMProvFiles, _defaultProcesses
+from PhysicsTools.HeppyCore.utils.IMProv.BenchmarkHarness import benchmarkParser, inChild, timeRepeated, runBenchmark
+
+
+#  //
+# // Element names used at each level of the records, and values
+#//  of the Type attribute
+_Levels = ["Record", "File", "Run", "LumiSection", "Event", "Branch"]
+_Types = ["cksum", "adler32", "md5", "size"]
+
+
+def levelName(level):
+    """
+    _levelName_
+
+    Element name of the nodes at level (1 for the records)
+
+    """
+    if level <= len(_Levels):
+        return _Levels[level - 1]
+    return "Level%d" % level
+
+
+def generateDocument(filename, records, depth, fanout, attributes, seed):
+    """
+    _generateDocument_
+
+    Write an XML document with records children of the document
+    element, each the top of a tree with depth levels and fanout
+    children per node.
+
+    Each node has an ID attribute, its position among its siblings,
+    a Type attribute taken from _Types and attributes - 2 more
+    attributes with random values, and the leaves have random text.
+    Returns the number of nodes, the document element included
+
+    """
+    generator = random.Random(seed)
+    handle = open(filename, 'w')
+    handle.write('<?xml version="1.0" ?>\n<Benchmark>\n')
+    nodes = 1
+    for record in xrange(records):
+        #  //
+        # // (level, position) of the nodes still to be written, with
+        #//  the end tags to write once their children are done
+        stack = [(1, record)]
+        while stack:
+            level, position = stack.pop()
+            if level is None:
+                handle.write(position)
+                continue
+            nodes += 1
+            name = levelName(level)
+            attrs = []
+            if attributes > 0:
+                attrs.append(' ID="%d"' % position)
+            if attributes > 1:
+                attrs.append(' Type="%s"' % _Types[generator.randrange(
+                    len(_Types))])
+            for index in range(2, attributes):
+                attrs.append(' Attr%d="%08x"' % (index,
+                                                 generator.getrandbits(32)))
+            indent = "  " * level
+            if level == depth:
+                handle.write('%s<%s%s>%08x</%s>\n' % (
+                    indent, name, "".join(attrs),
+                    generator.getrandbits(32), name))
+                continue
+            handle.write('%s<%s%s>\n' % (indent, name, "".join(attrs)))
+            stack.append((None, '%s</%s>\n' % (indent, name)))
+            for child in reversed(range(fanout)):
+                stack.append((level + 1, child))
+    handle.write('</Benchmark>\n')
+    handle.close()
+    return nodes
+
+
+def benchLoadFile(filename, repeat, loader, compact):
+    """
+    _benchLoadFile_
+
+    Time loading the document from its file with loader
+
+    """
+    result, document = timeRepeated(
+        lambda: loader(filename, compact = compact), repeat)
+    result["children"] = len(document.children)
+    return result
+
+
+def benchLoadString(filename, repeat):
+    """
+    _benchLoadString_
+
+    Time loadIMProvString on the content of the document file
+
+    """
+    handle = open(filename)
+    content = handle.read()
+    handle.close()
+    result, document = timeRepeated(lambda: loadIMProvString(content),
+                                    repeat)
+    result["bytes"] = len(content)
+    return result
+
+
+def benchQuery(filename, repeat, query):
+    """
+    _benchQuery_
+
+    Time the query on the loaded document: as in real use, the runs
+    after the first one use the indexes the first one built, so the
+    median is the time of an indexed query
+
+    """
+    document = fastLoadIMProvFile(filename)
+    result, matches = timeRepeated(lambda: IMProvQuery(query)(document),
+                                   repeat)
+    result["query"] = query
+    result["results"] = len(matches)
+    return result
+
+
+def benchProcessNodes(filename, repeat):
+    """
+    _benchProcessNodes_
+
+    Time processNodes with a callback counting the nodes
+
+    """
+    document = fastLoadIMProvFile(filename)
+    def process():
+        nodes = []
+        document.processNodes(nodes.append)
+        return len(nodes)
+    result, count = timeRepeated(process, repeat)
+    result["nodes"] = count
+    return result
+
+
+def benchPrettyXML(filename, repeat):
+    """
+    _benchPrettyXML_
+
+    Time makeDOMElement().toprettyxml() on the loaded document
+
+    """
+    document = fastLoadIMProvFile(filename)
+    result, output = timeRepeated(
+        lambda: document.makeDOMElement().toprettyxml(), repeat)
+    result["characters"] = len(output)
+    return result
+
+
+def benchStr(filename, repeat):
+    """
+    _benchStr_
+
+    Time str() on the loaded document
+
+    """
+    document = fastLoadIMProvFile(filename)
+    result, output = timeRepeated(lambda: str(document), repeat)
+    result["characters"] = len(output)
+    return result
+
+
+def benchSerialFiles(filenames, repeat, query):
+    """
+    _benchSerialFiles_
+
+    Time loading the files one after another with fastLoadIMProvFile
+    into compact trees, running the query on each if it is not None,
+    as IMProvBulkLoader does in its workers
+
+    """
+    def load():
+        results = []
+        for filename in filenames:
+            document = fastLoadIMProvFile(filename, compact = True)
+            if query is not None:
+                document = compileQuery(query)(document)
+            results.append(document)
+        return results
+    result, results = timeRepeated(load, repeat)
+    result["files"] = len(results)
+    return result
+
+
+def benchBulkFiles(filenames, repeat, query, processes):
+    """
+    _benchBulkFiles_
+
+    Time loading the files with loadIMProvFiles and processes worker
+    processes, the pool being started for each run, or with the
+    default number of processes if processes is None
+
+    """
+    result, results = timeRepeated(
+        lambda: loadIMProvFiles(filenames, query = query,
+                                processes = processes), repeat)
+    result["files"] = len(results)
+    result["errors"] = len([error for name, value, error in results
+                            if error is not None])
+    if processes is None:
+        result["processes"] = _defaultProcesses(filenames, query, None)
+    return result
+
+
+def loadedDocument(filename):
+    """
+    _loadedDocument_
+
+    Baseline measurement of a child process that loaded the document
+
+    """
+    document = fastLoadIMProvFile(filename)
+    return {"children" : len(document.children)}
+
+
+def benchmark(options, workDir):
+    """
+    _benchmark_
+
+    Generate the document in workDir and run the measurements
+
+    """
+    leaf = levelName(options.depth)
+    queries = {
+        "relative" : leaf,
+        "absolute" : "/Benchmark/Record/%s" % levelName(
+            min(2, options.depth)),
+        "wildcard" : "Record/*",
+        "predicateAttribute" : '%s[attribute("Type")=="cksum"]' % leaf,
+        "predicateText" : 'Record[attribute("ID")=="1"]/*[text()]',
+        }
+
+    filename = os.path.join(workDir, "benchmark.xml")
+    nodes = generateDocument(filename, options.records, options.depth,
+                             options.fanout, options.attributes,
+                             options.seed)
+    report = {
+        "parameters" : {"records" : options.records,
+                        "depth" : options.depth,
+                        "fanout" : options.fanout,
+                        "attributes" : options.attributes,
+                        "repeat" : options.repeat,
+                        "seed" : options.seed},
+        "document" : {"nodes" : nodes,
+                      "bytes" : os.path.getsize(filename)},
+        "loadedDocument" : inChild(loadedDocument, filename),
+        "loadIMProvFile" : inChild(benchLoadFile, filename,
+                                   options.repeat, loadIMProvFile, False),
+        "loadIMProvFile-compact" : inChild(benchLoadFile, filename,
+                                           options.repeat,
+                                           loadIMProvFile, True),
+        "fastLoadIMProvFile" : inChild(benchLoadFile, filename,
+                                       options.repeat,
+                                       fastLoadIMProvFile, False),
+        "fastLoadIMProvFile-compact" : inChild(benchLoadFile, filename,
+                                               options.repeat,
+                                               fastLoadIMProvFile, True),
+        "loadIMProvString" : inChild(benchLoadString, filename,
+                                     options.repeat),
+        "processNodes" : inChild(benchProcessNodes, filename,
+                                 options.repeat),
+        "toprettyxml" : inChild(benchPrettyXML, filename, options.repeat),
+        "str" : inChild(benchStr, filename, options.repeat),
+        }
+    for name, query in queries.items():
+        report["query-%s" % name] = inChild(benchQuery, filename,
+                                            options.repeat, query)
+
+    if options.files:
+        #  //
+        # // Many smaller documents, for IMProvBulkLoader
+        #//
+        filenames = []
+        for index in range(options.files):
+            filenames.append(os.path.join(workDir, "bulk%d.xml" % index))
+            generateDocument(filenames[-1], options.fileRecords,
+                             options.depth, options.fanout,
+                             options.attributes, options.seed + index)
+        report["parameters"].update(files = options.files,
+                                    fileRecords = options.fileRecords,
+                                    processes = options.processes)
+        for name, query in (("query", queries["predicateAttribute"]),
+                            ("trees", None)):
+            report["bulk-%s-serial" % name] = inChild(
+                benchSerialFiles, filenames, options.repeat, query)
+            for processes in options.processes:
+                report["bulk-%s-processes%d" % (name, processes)] = inChild(
+                    benchBulkFiles, filenames, options.repeat, query,
+                    processes)
+            report["bulk-%s-auto" % name] = inChild(
+                benchBulkFiles, filenames, options.repeat, query, None)
+    return report
+
+
+def main(argv):
+    """
+    _main_
+
+    Parse the command line and run the benchmarks
+
+    """
+    parser = benchmarkParser(5, "number of runs of each measurement")
+    parser.add_option("--records", type = "int", default = 2000,
+                      help = "number of records in the document")
+    parser.add_option("--depth", type = "int", default = 3,
+                      help = "number of levels of each record")
+    parser.add_option("--fanout", type = "int", default = 4,
+                      help = "number of children of the non leaf nodes")
+    parser.add_option("--attributes", type = "int", default = 3,
+                      help = "number of attributes per node")
+    parser.add_option("--files", type = "int", default = 200,
+                      help = "number of documents to bulk load (0 for none)")
+    parser.add_option("--file-records", type = "int", default = 20,
+                      dest = "fileRecords",
+                      help = "number of records in each bulk loaded document")
+    parser.add_option("--processes", default = "1,2,4",
+                      help = "comma separated numbers of bulk loader processes")
+    options, args = parser.parse_args(argv)
+    if options.depth < 1 or options.fanout < 1:
+        parser.error("--depth and --fanout must be at least 1")
+    try:
+        options.processes = [int(value)
+                             for value in options.processes.split(",")]
+    except ValueError:
+        parser.error("--processes must be a list of numbers")
+    return runBenchmark(options, "improvbench", benchmark)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
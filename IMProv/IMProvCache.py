@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+_IMProvCache_
+
+On disk cache of parsed IMProv XML files.
+
+IMProvFileCache.load returns the same tree as fastLoadIMProvFile, but
+keeps a marshalled copy of the tree of each file it loads in a cache
+directory and builds the tree from that copy when the file has not
+changed since, which is several times faster than parsing it again.
+
+An entry records the path, size and modification time of the file it
+was made from, and its md5 digest if useDigest is set: it is used as is
+when the size and modification time still match, and only if the
+digest of the file still matches otherwise.
+
+The entries are written to a temporary file and renamed, so that
+concurrent readers and writers never see a partial entry.
+Each use of an entry updates its modification time, and when the
+entries take more than maxSize bytes the least recently used ones are
+removed.
+
+An entry that cannot be read or written is ignored, the XML file is
+then parsed.
+
+"""
+
+import os
+import marshal
+import hashlib
+
+#from IMProv.IMProvExpatLoader import fastLoadIMProvFile
+#from IMProv.IMProvLoader import _nodeClasses
+#from IMProv.IMProvUtils import suspendedGC, fileDigest, writeMarshalled
+#from IMProv.IMProvCompactNode import internedAttrs
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvExpatLoader import fastLoadIMProvFile
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvLoader import _nodeClasses
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import suspendedGC, fileDigest, writeMarshalled
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvCompactNode import internedAttrs
+
+#  //
+# // Bump this when the content of the entries changes
+#//
+CacheVersion = 1
+
+_EntrySuffix = ".improv"
+
+
+def flattenIMProvTree(improvNode):
+    """
+    _flattenIMProvTree_
+
+    Return the list of (name, attrs, chardata, number of children)
+    tuples for improvNode and its descendants, in tree order, attrs
+    being None for nodes without attributes
+
+    """
+    result = []
+    stack = [improvNode]
+    while stack:
+        node = stack.pop()
+        attrs = node.attrs
+        if attrs:
+            attrs = dict(attrs)
+        else:
+            attrs = None
+        children = node.children
+        result.append((node.name, attrs, node.chardata, len(children)))
+        stack.extend(reversed(children))
+    return result
+
+
+def buildIMProvTree(flatTree, compact = False):
+    """
+    _buildIMProvTree_
+
+    Build the IMProv Tree from the list made by flattenIMProvTree, the
+    first node becoming the document.
+    If compact is True, the tree is made of IMProvCompactNodes
+
+    """
+    docClass, nodeClass = _nodeClasses(compact)
+    entries = iter(flatTree)
+    name, attrs, chardata, count = entries.next()
+    document = docClass(intern(name))
+    if attrs:
+        document.attrs = attrs
+    document.chardata = chardata
+    #  //
+    # // Nodes still receiving children, how many they still miss,
+    #//  and the children of the compact ones so far
+    parents = [document]
+    remaining = [count]
+    children = [[]]
+    update = dict.update
+    with suspendedGC():
+        for name, attrs, chardata, count in entries:
+            name = intern(name)
+            node = nodeClass(name, chardata)
+            if compact:
+                #  //
+                # // The attribute names were interned when the entry
+                #//  was written, and the children are set once complete
+                if attrs:
+                    node._Attrs = internedAttrs(attrs)
+                children[-1].append(node)
+            else:
+                if attrs:
+                    update(node.attrs, attrs)
+                #  //
+                # // IMProvNode.addNode without the type check
+                #//
+                parent = parents[-1]
+                parent.children.append(node)
+                dict.setdefault(parent, name, []).append(node)
+            remaining[-1] -= 1
+            if count:
+                parents.append(node)
+                remaining.append(count)
+                children.append([])
+                continue
+            while remaining and not remaining[-1]:
+                parent = parents.pop()
+                if compact:
+                    parent.children = children[-1]
+                children.pop()
+                remaining.pop()
+    return document
+
+
+class IMProvFileCache:
+    """
+    _IMProvFileCache_
+
+    Cache of parsed IMProv XML files in the directory cacheDir, created
+    if needed, see module docs
+
+    """
+    def __init__(self, cacheDir, maxSize = 256 * 1024 * 1024,
+                 useDigest = False):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.useDigest = useDigest
+
+
+    def entryName(self, filename, compact = False):
+        """
+        _entryName_
+
+        Name of the cache entry for the XML file provided, compact
+        trees having their own entries
+        """
+        path = os.path.abspath(filename)
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        if compact:
+            path += "\0compact"
+        return os.path.join(self.cacheDir,
+                            hashlib.md5(path).hexdigest() + _EntrySuffix)
+
+
+    def load(self, filename, compact = False):
+        """
+        _load_
+
+        Load the XML file into an IMProv Tree, from its cache entry
+        if it is up to date, see fastLoadIMProvFile
+        """
+        path = os.path.abspath(filename)
+        entry = self.entryName(path, compact)
+        flatTree = self._ReadEntry(path, entry)
+        if flatTree is not None:
+            return buildIMProvTree(flatTree, compact)
+
+        stat = os.stat(path)
+        digest = None
+        if self.useDigest:
+            digest = fileDigest(path)
+        improvNode = fastLoadIMProvFile(path, compact)
+        if self._WriteEntry(path, entry, stat, digest,
+                            flattenIMProvTree(improvNode)):
+            self._Evict()
+        return improvNode
+
+
+    def _ReadEntry(self, path, entry):
+        """
+        _ReadEntry_
+
+        Return the flattened tree stored in the entry for path, or None
+        if there is no usable entry
+        """
+        try:
+            handle = open(entry, 'rb')
+            try:
+                #  //
+                # // Check the header before loading the tree
+                #//
+                version, entryPath, signature, digest = marshal.load(handle)
+                if version != CacheVersion or entryPath != path:
+                    return None
+                stat = os.stat(path)
+                upToDate = (stat.st_size, stat.st_mtime) == tuple(signature)
+                if not upToDate:
+                    if digest is None or fileDigest(path) != digest:
+                        return None
+                with suspendedGC():
+                    flatTree = marshal.load(handle)
+            finally:
+                handle.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not upToDate:
+            #  //
+            # // Content unchanged, record the new size and time
+            #//
+            self._WriteEntry(path, entry, stat, digest, flatTree)
+            return flatTree
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return flatTree
+
+
+    def _WriteEntry(self, path, entry, stat, digest, flatTree):
+        """
+        _WriteEntry_
+
+        Store the flattened tree read from path, whose os.stat and
+        digest at the time it was read are provided, in entry.
+
+        The entry is written to a temporary file and renamed so that
+        concurrent readers never see a partial entry.
+        Returns True if the entry was written
+        """
+        header = (CacheVersion, path, (stat.st_size, stat.st_mtime), digest)
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+        except OSError:
+            if not os.path.isdir(self.cacheDir):
+                return False
+        return writeMarshalled(entry, [header, flatTree])
+
+
+    def _Evict(self):
+        """
+        _Evict_
+
+        Remove the least recently used entries until the entries take
+        no more than maxSize bytes
+        """
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.cacheDir)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(".") or not name.endswith(_EntrySuffix):
+                continue
+            entry = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            total -= size
+        return
+
+
+def loadCachedIMProvFile(filename, cacheDir, compact = False):
+    """
+    _loadCachedIMProvFile_
+
+    Load an XML Document into an IMProv Tree, through the cache of
+    parsed files in cacheDir, see IMProvFileCache
+    """
+    return IMProvFileCache(cacheDir).load(filename, compact)
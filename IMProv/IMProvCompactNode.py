@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+_IMProvCompactNode_
+
+Memory efficient alternative to IMProvNode for large read mostly
+IMProv trees such as loaded job reports and catalogs.
+
+IMProvCompactNode provides the name, attrs, children, chardata and
+addNode API of IMProvNode, but:
+
+- it uses __slots__ instead of being a dictionary with a __dict__
+- the attrs dictionary and children list are only allocated when
+  the node has attributes or children: the attrs of a node without
+  attributes is a shared read only empty dictionary, assign a
+  dictionary to attrs to give it some
+- tag and attribute names are interned, so that all the nodes with
+  the same name share a single string
+- chardata is not stored when there is no text
+
+Nodes can be looked up by name with node[name], which scans the
+children, rather than through a dictionary kept up to date by addNode.
+
+Nodes are pickled as their name, attributes, children and chardata
+only, so that a pickled subtree does not drag in its document.
+
+"""
+
+import weakref
+from xml.dom.minidom import Document
+
+#from IMProv.IMProvNode import IMProvNodeMethods, IMProvAttrs
+#from IMProv.IMProvHash import invalidateHash
+#from IMProv.IMProvDoc import IMProvNameIndex
+#from IMProv.IMProvException import IMProvException
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvNode import IMProvNodeMethods, IMProvAttrs
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvHash import invalidateHash
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvDoc import IMProvNameIndex
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvException import IMProvException
+
+
+def internName(name):
+    """
+    _internName_
+
+    Return the interned str for a tag or attribute name, or the name
+    itself if it cannot be converted to str
+
+    """
+    try:
+        return intern(str(name))
+    except UnicodeError:
+        return name
+
+
+class IMProvCompactNode(IMProvNodeMethods):
+    """
+    _IMProvCompactNode_
+
+    Compact node in an IMProv Tree, see module docs
+
+    children is an empty tuple until the first child is added with
+    addNode, attrs is the read only NoAttrs until attributes are
+    assigned to it
+
+    """
+    __slots__ = ("name", "_Attrs", "_Children", "_CharData", "_Doc",
+                 "_Hash", "_Parent", "__weakref__")
+
+    def __init__(self, name, text = None, **attrs):
+        self.name = internName(name)
+        self._Attrs = None
+        self._Children = None
+        self._Doc = None
+        self._Hash = None
+        self._Parent = None
+        self._CharData = None
+        self.chardata = str(text)
+        if attrs:
+            self.attrs = attrs
+
+
+    def _GetAttrs(self):
+        if self._Attrs is None:
+            return NoAttrs
+        return self._Attrs
+
+    def _SetAttrs(self, attrs):
+        newAttrs = self._Attrs = _InternedAttrs()
+        newAttrs._Node = None
+        dict.update(newAttrs, _internKeys(attrs))
+        if self._Hash is not None or self._Doc is not None:
+            newAttrs._Node = weakref.ref(self)
+            self._AttrsChanged()
+
+    attrs = property(_GetAttrs, _SetAttrs)
+
+
+    def _WatchAttrs(self):
+        """
+        _WatchAttrs_
+
+        Return the attributes of the node, or None if it has none,
+        making their changes call _AttrsChanged from now on
+        """
+        attrs = self._Attrs
+        if attrs is not None:
+            attrs._Node = weakref.ref(self)
+        return attrs
+
+
+    def _GetChildren(self):
+        if self._Children is None:
+            return ()
+        return self._Children
+
+    def _SetChildren(self, children):
+        self._Children = list(children) or None
+        if self._Doc is not None or self._Hash is not None:
+            self._ChildrenChanged()
+
+    children = property(_GetChildren, _SetChildren)
+
+
+    def _GetCharData(self):
+        if self._CharData is None:
+            return str(None)
+        return self._CharData
+
+    def _SetCharData(self, text):
+        if text is None or text == str(None):
+            self._CharData = None
+        else:
+            self._CharData = text
+        if self._Hash is not None:
+            invalidateHash(self)
+
+    chardata = property(_GetCharData, _SetCharData)
+
+
+    def __getstate__(self):
+        return (self.name, self._Attrs, self._Children, self._CharData)
+
+    def __setstate__(self, state):
+        name, self._Attrs, self._Children, self._CharData = state
+        self.name = internName(name)
+        self._Doc = None
+        self._Hash = None
+        self._Parent = None
+
+
+    def addNode(self, node):
+        """
+        _addNode_
+
+        Add a child node to this node
+
+        Args --
+
+        - *node* : Instance of IMProvCompactNode (or IMProvNode) to be
+        added as child
+        """
+        if not isinstance(node, IMProvNodeMethods):
+            msg = "Value is not an IMProvNode instance"
+            raise IMProvException(
+                msg, ClassInstance = self,
+                Value = node)
+        if self._Children is None:
+            self._Children = [node]
+        else:
+            self._Children.append(node)
+        if self._Doc is not None or self._Hash is not None:
+            self._ChildrenChanged()
+        return
+
+
+    def __getitem__(self, name):
+        """
+        _operator[]_
+
+        Return the list of children with the name provided, raise
+        KeyError if there are none, as IMProvNode does
+        """
+        result = [child for child in self.children if child.name == name]
+        if not result:
+            raise KeyError, name
+        return result
+
+
+    def get(self, name, default = None):
+        """
+        _get_
+
+        Return the list of children with the name provided, or default
+        """
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+    def has_key(self, name):
+        """
+        _has_key_
+
+        Return True if the node has a child with the name provided
+        """
+        for child in self.children:
+            if child.name == name:
+                return True
+        return False
+
+    __contains__ = has_key
+
+
+    def keys(self):
+        """
+        _keys_
+
+        Return the names of the children, in order of first occurence
+        """
+        result = []
+        for child in self.children:
+            if child.name not in result:
+                result.append(child.name)
+        return result
+
+
+
+class IMProvCompactDoc(IMProvNameIndex, IMProvCompactNode):
+    """
+    _IMProvCompactDoc_
+
+    IMProvCompactNode counterpart of IMProvDoc, the top level node
+    of a compact IMProv tree
+
+    """
+    __slots__ = ("_NameIndex", "_AttributeIndexes")
+
+    def __init__(self, baseNodeName = "IMProvDoc"):
+        IMProvCompactNode.__init__(self, baseNodeName)
+        self._NameIndex = None
+        self._AttributeIndexes = None
+
+    def __setstate__(self, state):
+        IMProvCompactNode.__setstate__(self, state)
+        self._NameIndex = None
+        self._AttributeIndexes = None
+
+
+    def makeDOMDocument(self):
+        """
+        _makeDOMDocument_
+
+        Create a DOM Document from all sub nodes
+        """
+        doc = Document()
+        doc.appendChild(self.makeDOMElement())
+        return doc
+
+
+
+class _NoAttrs(dict):
+    """
+    _NoAttrs_
+
+    Read only empty attribute dictionary, see NoAttrs
+
+    """
+    __slots__ = ()
+
+    def _ReadOnly(self, *args, **kwargs):
+        msg = "Node has no attributes: assign a dictionary to attrs "
+        msg += "to set them"
+        raise IMProvException(msg)
+
+    __setitem__ = __delitem__ = update = setdefault = _ReadOnly
+    pop = popitem = clear = _ReadOnly
+
+    def __reduce__(self):
+        return _noAttrs, ()
+
+
+def _noAttrs():
+    """
+    _noAttrs_
+
+    Unpickle NoAttrs
+    """
+    return NoAttrs
+
+#  //
+# // The attrs of all the IMProvCompactNodes without attributes
+#//
+NoAttrs = _NoAttrs()
+
+
+def internedAttrs(attrs):
+    """
+    _internedAttrs_
+
+    Return the attrs of a new node for the mapping attrs, whose names
+    must already be interned, for loaders to set as the _Attrs of the
+    nodes they make instead of assigning attrs
+
+    """
+    newAttrs = _InternedAttrs(attrs)
+    newAttrs._Node = None
+    return newAttrs
+
+
+def _internKeys(attrs):
+    """
+    _internKeys_
+
+    Return the (interned name, value) pairs of the mapping attrs
+
+    """
+    return [(key.__class__ is str and intern(key) or internName(key), value)
+            for key, value in attrs.items()]
+
+
+class _InternedAttrs(IMProvAttrs):
+    """
+    _InternedAttrs_
+
+    Attribute dictionary interning its keys
+
+    """
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        IMProvAttrs.__setitem__(self, internName(key), value)
+
+    def update(self, *args, **kwargs):
+        IMProvAttrs.update(self, _internKeys(dict(*args, **kwargs)))
+
+    def setdefault(self, key, default = None):
+        return IMProvAttrs.setdefault(self, internName(key), default)
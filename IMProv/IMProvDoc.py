@@ -14,12 +14,17 @@ __version__ = "$Revision: 1.1 $"
 __revision__ = "$Id: IMProvDoc.py,v 1.1 2006/04/10 17:01:33 evansde Exp $"
 
 import os
+import weakref
 
 from xml.dom.minidom import Document
 #from xml.dom.ext import PrettyPrint
 #from IMProv.IMProvNode import IMProvNode
+#from IMProv.IMProvWriter import writeIMProvFile
+#from IMProv.IMProvUtils import suspendedGC
 
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvNode import IMProvNode
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvWriter import writeIMProvFile
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import suspendedGC
 
 
 
@@ -31,10 +36,7 @@ def saveIMProvDoc(soRef, mdName):
     targetDir = soRef.GetPersistentPath()
     targetFile = "%s-IMProvDoc.xml" % mdName
     target = os.path.join(targetDir, targetFile)
-    dom = improv.makeDOMDocument()
-    handle = open(target, 'w')
-    handle.write(dom.toprettyxml())
-    handle.close()
+    writeIMProvFile(improv, target, document = True)
     
     mdLine = "%s SaveFile=%s\n" % (
         mdName,
@@ -51,19 +53,172 @@ def loadIMProvDoc(soRef, mdName, mdLine):
     """
     pass
 
-class IMProvDoc(IMProvNode):
+class IMProvNameIndex(object):
+    """
+    _IMProvNameIndex_
+
+    Index of the nodes of a document by name, shared by IMProvDoc and
+    IMProvCompactDoc, which provide _NameIndex and _AttributeIndexes
+    attributes.
+
+    The index is built on first use, by relative queries, and dropped
+    with dropNameIndex. Building it sets the _Doc attribute of every
+    node to a weak reference to the document, so that addNode on any of
+    them, or setting the children of a compact node, drops the index,
+    while a node kept after the document is dropped does not keep the
+    document and its indexes alive. The indexes do not include the
+    document itself either, so that the document is freed as soon as
+    it is no longer used. Changes made to the children lists in place
+    are not seen by the index
+
+    Indexes of nodes by attribute value are only built on request, with
+    indexAttribute, and are rebuilt on next use when the name index is
+    dropped or when the attributes of a node with the indexed name
+    change: the attribute dictionaries of the indexed nodes tell them
+    about their changes (see IMProvAttrs)
+
+    """
+    __slots__ = ()
+
+    def nameIndex(self):
+        """
+        _nameIndex_
+
+        Return the dictionary of name : list of nodes with that name,
+        in tree order, for all the descendants of this node.
+        The list of all the nodes is stored under "*"
+        """
+        index = self._NameIndex
+        if index is not None:
+            return index
+        index = {}
+        allNodes = []
+        document = weakref.ref(self)
+        self._Doc = document
+        stack = list(reversed(self.children))
+        while stack:
+            node = stack.pop()
+            node._Doc = document
+            allNodes.append(node)
+            try:
+                index[node.name].append(node)
+            except KeyError:
+                index[node.name] = [node]
+            stack.extend(reversed(node.children))
+        index["*"] = allNodes
+        self._NameIndex = index
+        return index
+
+
+    def dropNameIndex(self):
+        """
+        _dropNameIndex_
+
+        Drop the name index and the content of the attribute indexes,
+        to free their memory. They are rebuilt on next use
+        """
+        self._NameIndex = None
+        if self._AttributeIndexes:
+            for key in self._AttributeIndexes.keys():
+                self._AttributeIndexes[key] = None
+        return
+
+
+    def indexAttribute(self, name, attr):
+        """
+        _indexAttribute_
+
+        Build, or rebuild, the index of the nodes with the name
+        provided ("*" for all the nodes) by the value of their
+        attribute attr, and keep it up to date from then on: it is
+        rebuilt on next use after a change to the indexed nodes.
+        Relative queries whose first term is name[attribute("attr")==value]
+        start from the nodes it provides instead of all the nodes
+        with that name.
+
+        Returns the dictionary of value : list of nodes with that
+        value, in tree order. Nodes without the attribute, or with a
+        value that cannot be hashed, are not included, nor is the
+        document itself
+        """
+        if self._AttributeIndexes is None:
+            self._AttributeIndexes = {}
+        self._AttributeIndexes[(name, attr)] = None
+        return self.attributeIndex(name, attr)
+
+
+    def attributeIndex(self, name, attr):
+        """
+        _attributeIndex_
+
+        Return the index of the nodes with the name provided by
+        the value of their attribute attr, or None if it has not been
+        requested with indexAttribute
+        """
+        indexes = self._AttributeIndexes
+        if not indexes or (name, attr) not in indexes:
+            return None
+        nameIndex = self.nameIndex()
+        entry = indexes[(name, attr)]
+        if entry is not None and entry[0] is nameIndex:
+            return entry[1]
+        #  //
+        # // Build the index from the name index, it is stored with
+        #//  the name index it was built from to tell when it is stale
+        index = {}
+        with suspendedGC():
+            for node in nameIndex.get(name, ()):
+                value = node.attrs.get(attr, None)
+                node._WatchAttrs()
+                if value is None:
+                    continue
+                try:
+                    index[value].append(node)
+                except KeyError:
+                    index[value] = [node]
+                except TypeError:
+                    continue
+        indexes[(name, attr)] = (nameIndex, index)
+        return index
+
+
+    def _DropAttributeIndexes(self, name):
+        """
+        _DropAttributeIndexes_
+
+        Drop the attribute indexes that may include the nodes with the
+        name provided, they are rebuilt on next use
+        """
+        for key in self._AttributeIndexes.keys():
+            if key[0] in (name, "*"):
+                self._AttributeIndexes[key] = None
+        return
+
+
+
+class IMProvDoc(IMProvNameIndex, IMProvNode):
     """
     _IMProvDoc_
 
     Document element container that acts as a toplevel
     document for a set of IMProvNodes containing data
+
+    Relative queries on the document use its nameIndex
     
     """
     
     _Schema = ['Object']
+
+    #  //
+    # // Not pickled, see IMProvNode
+    #//
+    _NameIndex = None
+    _AttributeIndexes = None
     
     def __init__(self, baseNodeName = "IMProvDoc"):
         IMProvNode.__init__(self, baseNodeName)
+        self._NameIndex = None
+        self._AttributeIndexes = None
         
     def makeDOMDocument(self):
         """
@@ -90,3 +245,66 @@ class IMProvDoc(IMProvNode):
         typeVal = str(self.__class__.__name__)
         soRef.addItem( attrName, typeVal , Object=self)
         return
+
+
+
+if __name__ == '__main__':
+    #  //
+    # // Check that attribute indexes follow the changes made to the
+    #//  attributes of the indexed nodes
+    from PhysicsTools.HeppyCore.utils.IMProv.IMProvLoader import loadIMProvString
+    from PhysicsTools.HeppyCore.utils.IMProv.IMProvQuery import IMProvQuery
+    from PhysicsTools.HeppyCore.utils.IMProv.IMProvNode import IMProvNode
+
+    xml = """<storage-mapping>
+      <lfn-to-pfn protocol="direct" path-match="/store/(.*)" result="/a/$1"/>
+      <lfn-to-pfn protocol="srm" path-match="/store/(.*)" result="/b/$1"/>
+      <lfn-to-pfn path-match="/tmp/(.*)" result="/c/$1"/>
+      </storage-mapping>"""
+    query = 'lfn-to-pfn[attribute("protocol")=="xrootd"]'
+
+    def check(doc, expected):
+        indexed = len(IMProvQuery(query)(doc))
+        scanned = len([node for node in IMProvQuery("lfn-to-pfn")(doc)
+                       if node.attrs.get("protocol", None) == "xrootd"])
+        assert indexed == scanned == expected, (indexed, scanned, expected)
+
+    for compact in (False, True):
+        doc = loadIMProvString(xml, compact)
+        doc.indexAttribute("lfn-to-pfn", "protocol")
+        check(doc, 0)
+        mappings = doc.children
+        mappings[0].attrs["protocol"] = "xrootd"
+        check(doc, 1)
+        mappings[2].attrs["protocol"] = "xrootd"
+        check(doc, 2)
+        mappings[0].attrs = {"protocol" : "srm"}
+        check(doc, 1)
+        mappings[2].attrs.pop("protocol")
+        check(doc, 0)
+        mappings[1].attrs.update(protocol = "xrootd")
+        check(doc, 1)
+        node = IMProvNode("lfn-to-pfn", protocol = "xrootd")
+        doc.addNode(node)
+        check(doc, 2)
+        node.attrs["protocol"] = "direct"
+        check(doc, 1)
+    print "attribute index checks passed"
+
+    #  //
+    # // Check that a document is freed, without the cycle collector,
+    #//  while a node found with its indexes is kept
+    import gc
+    for compact in (False, True):
+        doc = loadIMProvString(xml, compact)
+        doc.indexAttribute("lfn-to-pfn", "protocol")
+        kept = IMProvQuery('lfn-to-pfn[attribute("protocol")=="srm"]')(doc)
+        kept[0].attrs["protocol"] = "xrootd"
+        document = weakref.ref(doc)
+        gc.disable()
+        del doc
+        assert document() is None, "document kept alive"
+        gc.enable()
+        assert kept[0].attrs["protocol"] == "xrootd"
+        kept[0].addNode(IMProvNode("pfn"))
+    print "document lifetime checks passed"
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+_IMProvExpatLoader_
+
+Fast alternative to IMProvLoader that builds the IMProv tree with
+callbacks straight from the pyexpat parser instead of going through
+xml.sax.
+
+The tree is the same as the one built by loadIMProvFile and
+loadIMProvString:
+
+- the document element becomes an IMProvDoc without attributes
+- the other elements become IMProvNodes whose attributes keep the
+  unicode keys and values provided by the parser
+- the chardata of a node is the text following its last child
+  (or all its text if it has none), stripped and converted with str()
+
+Text is accumulated in a list and joined once per element, element
+names are converted and interned once per distinct name and the
+attributes made by the parser are copied with a single dict.update.
+The cyclic garbage collector is suspended during the parse, the tree
+has no reference cycles.
+
+Parse errors raise xml.parsers.expat.ExpatError
+
+"""
+
+from xml.parsers import expat
+
+#from IMProv.IMProvLoader import _nodeClasses
+#from IMProv.IMProvUtils import suspendedGC
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvLoader import _nodeClasses
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import suspendedGC
+
+
+class IMProvExpatBuilder:
+    """
+    _IMProvExpatBuilder_
+
+    pyexpat handlers building an IMProv Tree, the document node is
+    available as document once the parse is complete.
+
+    If compact is True, the tree is built from IMProvCompactNodes
+
+    """
+    def __init__(self, compact = False):
+        self.document = None
+        self._DocClass, self._NodeClass = _nodeClasses(compact)
+        self._Compact = compact
+        self._NodeStack = []
+        self._CharCache = []
+        self._Names = {}
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        self.parser.CharacterDataHandler = self._CharCache.append
+
+
+    def startElement(self, name, attrs):
+        """
+        _startElement_
+
+        pyexpat StartElementHandler
+        """
+        try:
+            name = self._Names[name]
+        except KeyError:
+            name = self._Names.setdefault(name, intern(str(name)))
+        if self.document is None:
+            self.document = self._DocClass(name)
+            self._NodeStack.append(self.document)
+            return
+        del self._CharCache[:]
+        node = self._NodeClass(name)
+        parent = self._NodeStack[-1]
+        if self._Compact:
+            if attrs:
+                node.attrs = attrs
+            parent.addNode(node)
+        else:
+            #  //
+            # // Fill the new attribute dictionary in place, and
+            #//  IMProvNode.addNode without the type check
+            if attrs:
+                dict.update(node.attrs, attrs)
+            parent.children.append(node)
+            dict.setdefault(parent, name, []).append(node)
+        self._NodeStack.append(node)
+        return
+
+
+    def endElement(self, name):
+        """
+        _endElement_
+
+        pyexpat EndElementHandler
+        """
+        self._NodeStack.pop().chardata = str("".join(self._CharCache).strip())
+        del self._CharCache[:]
+        return
+
+
+
+def fastLoadIMProvFile(filename, compact = False):
+    """
+    _fastLoadIMProvFile_
+
+    Load an XML Document (a file name or an open file) into an
+    IMProv Tree, see loadIMProvFile
+    """
+    builder = IMProvExpatBuilder(compact)
+    if hasattr(filename, "read"):
+        handle = filename
+    else:
+        handle = open(filename, 'rb')
+    try:
+        with suspendedGC():
+            builder.parser.ParseFile(handle)
+    finally:
+        if handle is not filename:
+            handle.close()
+    return builder.document
+
+
+def fastLoadIMProvString(xmlString, compact = False):
+    """
+    _fastLoadIMProvString_
+
+    Treat string as an XML document and parse it into an IMProv
+    Tree, see loadIMProvString
+    """
+    builder = IMProvExpatBuilder(compact)
+    with suspendedGC():
+        builder.parser.Parse(xmlString, True)
+    return builder.document
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+_IMProvHash_
+
+Structural hashes of IMProv trees, for fast equality tests and diffs
+between trees.
+
+The structural hash of a node is the sha1 digest of the structural
+hashes of its children, in order, and of its name, attributes and
+chardata: two nodes have the same hash when their subtrees have the
+same content, whatever the type of the nodes (IMProvNode or
+IMProvCompactNode) and of the strings (str or unicode) they hold.
+
+Hashes are cached on the nodes and only computed for the subtrees that
+do not have one yet, so comparing a tree again costs nothing and diffs
+skip the identical subtrees of the trees compared.
+
+A change to a hashed node drops the cached hashes of that node and of
+its ancestors only, through parent links recorded while hashing, so
+that hashing the tree again only hashes the path to the change. The
+nodes call invalidateHash when they change.
+The changes seen are addNode, any change to the attribute dictionary
+of the node or its replacement and, for IMProvCompactNodes, setting
+the chardata and children. Replacing the chardata of an IMProvNode and
+changing children lists in place are not seen, call invalidateHash on
+the node after doing so, or invalidateHashes on the top of the tree.
+
+The parent links are weak references, so that hashing a tree does not
+make it cyclic and a subtree kept after its tree is dropped does not
+keep its ancestors alive. A node found under several parents links to
+all of them, and a change to it drops the hashes of the ancestors
+found through each of them, in all the trees it was hashed in.
+
+"""
+
+import weakref
+from hashlib import sha1
+from difflib import SequenceMatcher
+
+#from IMProv.IMProvUtils import suspendedGC
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import suspendedGC
+
+#  //
+# // Kinds of differences reported by diffIMProvTrees
+#//
+NODE_ADDED = "added"
+NODE_REMOVED = "removed"
+NODE_CHANGED = "changed"
+
+
+def invalidateHashes(improvNode):
+    """
+    _invalidateHashes_
+
+    Drop the cached structural hashes of the node, its ancestors and
+    its whole subtree
+
+    """
+    invalidateHash(improvNode)
+    for node in improvNode.iterNodes():
+        node._Hash = None
+    return
+
+
+def invalidateHash(improvNode):
+    """
+    _invalidateHash_
+
+    Drop the cached structural hashes of the node and its ancestors,
+    after a change that is not seen, see module docs.
+
+    A node without a hash has no hashed ancestor, as hashing a node
+    hashes its whole subtree, so the walk stops at the nodes without
+    one
+
+    """
+    nodes = [improvNode]
+    while nodes:
+        node = nodes.pop()
+        if node is None or node._Hash is None:
+            continue
+        node._Hash = None
+        parents = node._Parent
+        if parents is None:
+            continue
+        if parents.__class__ is tuple:
+            nodes.extend([parent() for parent in parents])
+        else:
+            nodes.append(parents())
+    return
+
+
+def _addParent(node, parent):
+    """
+    _addParent_
+
+    Record the weak reference parent as a parent of node, the
+    references to the parents that no longer exist are dropped
+    """
+    parents = node._Parent
+    if parents is None:
+        node._Parent = parent
+        return
+    if parents.__class__ is not tuple:
+        parents = (parents,)
+    for other in parents:
+        if other is parent:
+            return
+    parents = [other for other in parents if other() is not None]
+    if not parents:
+        node._Parent = parent
+        return
+    parents.append(parent)
+    node._Parent = tuple(parents)
+    return
+
+
+def _text(value):
+    """
+    _text_
+
+    Convert a name or value to the str it is hashed as
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+
+def _nodeContent(node):
+    """
+    _nodeContent_
+
+    Return the string hashed for the name, attributes and chardata of
+    node: the number of fields followed by the fields, as utf-8, joined
+    with NUL characters, or each prefixed with its length after a !
+    if a field contains a NUL character.
+
+    """
+    attrs = node._WatchAttrs()
+    fields = [node.name, node.chardata]
+    if attrs:
+        items = attrs.items()
+        items.sort()
+        for item in items:
+            fields.extend(item)
+    try:
+        content = "\0".join(fields)
+    except (TypeError, UnicodeError):
+        #  //
+        # // Not only str (ascii) and unicode values, convert them
+        #//  one by one and sort the attributes again
+        fields = [_text(node.name), _text(node.chardata)]
+        if attrs:
+            items = [(_text(key), _text(value)) for key, value in items]
+            items.sort()
+            for item in items:
+                fields.extend(item)
+        content = "\0".join(fields)
+    if content.count("\0") != len(fields) - 1:
+        fields = [_text(field) for field in fields]
+        return "!" + "".join(["%d:%s" % (len(field), field)
+                              for field in fields])
+    if content.__class__ is unicode:
+        content = content.encode("utf-8")
+    return "%d\0%s" % (len(fields), content)
+
+
+def _nodeDigest(node):
+    """
+    _nodeDigest_
+
+    Return the structural hash of node, computing and caching the
+    hashes of its subtree that are not cached yet
+    """
+    cached = node._Hash
+    if cached is not None:
+        return cached
+    #  //
+    # // Post order traversal: (node, weak reference to it if it has
+    #//  children, iterator over its children, digests of the children
+    #//  done so far), recording the parent of each child
+    stack = [(node, weakref.ref(node), iter(node.children), [])]
+    with suspendedGC():
+        while True:
+            current, reference, children, digests = stack[-1]
+            for child in children:
+                if child._Parent is not reference:
+                    _addParent(child, reference)
+                cached = child._Hash
+                if cached is not None:
+                    digests.append(cached)
+                    continue
+                children = child.children
+                if children:
+                    stack.append((child, weakref.ref(child),
+                                  iter(children), []))
+                else:
+                    stack.append((child, None, iter(()), []))
+                break
+            else:
+                stack.pop()
+                digest = sha1("%d\0%s%s" % (len(digests), "".join(digests),
+                                            _nodeContent(current))).digest()
+                current._Hash = digest
+                if not stack:
+                    return digest
+                stack[-1][3].append(digest)
+
+
+def structuralHash(improvNode):
+    """
+    _structuralHash_
+
+    Return the hex structural hash of the node and its subtree
+
+    """
+    return _nodeDigest(improvNode).encode("hex")
+
+
+def sameIMProvTree(improvNode1, improvNode2):
+    """
+    _sameIMProvTree_
+
+    Return True if the two nodes have the same content, subtrees
+    included
+
+    """
+    return _nodeDigest(improvNode1) == _nodeDigest(improvNode2)
+
+
+def diffIMProvTrees(oldNode, newNode):
+    """
+    _diffIMProvTrees_
+
+    Return the list of differences between the tree of oldNode and
+    that of newNode, as (kind, path, old node, new node) tuples:
+
+    - NODE_CHANGED : the name, attributes or chardata of the node differ
+    - NODE_REMOVED : the node of the old tree (new node None) has no
+      counterpart in the new tree
+    - NODE_ADDED : the node of the new tree (old node None) has no
+      counterpart in the old tree
+
+    path is the path of the node from the top, /name[i]/name[j]...,
+    i being the position of the node among the children of its parent
+    in the old tree, or in the new tree for added nodes. The changes of
+    a node come before those of its descendants.
+
+    The children of two nodes are matched as difflib.SequenceMatcher
+    matches their structural hashes, identical subtrees being skipped
+    without being traversed, and the children left unmatched in between
+    are compared in turn when they have the same name
+
+    """
+    differences = []
+    if _nodeDigest(oldNode) == _nodeDigest(newNode):
+        return differences
+    if oldNode.name != newNode.name:
+        differences.append((NODE_REMOVED, "/%s" % oldNode.name,
+                            oldNode, None))
+        differences.append((NODE_ADDED, "/%s" % newNode.name,
+                            None, newNode))
+        return differences
+    #  //
+    # // (path, old node, new node) pairs of nodes with the
+    #//  same name and different subtrees still to compare
+    stack = [("/%s" % oldNode.name, oldNode, newNode)]
+    while stack:
+        path, old, new = stack.pop()
+        if _nodeContent(old) != _nodeContent(new):
+            differences.append((NODE_CHANGED, path, old, new))
+        pairs = []
+        oldChildren = list(old.children)
+        newChildren = list(new.children)
+        oldDigests = [_nodeDigest(child) for child in oldChildren]
+        newDigests = [_nodeDigest(child) for child in newChildren]
+        #  //
+        # // Only match the children between the common head and tail
+        #//
+        head = 0
+        last = min(len(oldDigests), len(newDigests))
+        while head < last and oldDigests[head] == newDigests[head]:
+            head += 1
+        tail = 0
+        last -= head
+        while tail < last and oldDigests[-1 - tail] == newDigests[-1 - tail]:
+            tail += 1
+        matcher = SequenceMatcher(
+            None, oldDigests[head:len(oldDigests) - tail],
+            newDigests[head:len(newDigests) - tail], False)
+        for tag, oldStart, oldEnd, newStart, newEnd in matcher.get_opcodes():
+            if tag == "equal":
+                continue
+            oldStart += head
+            oldEnd += head
+            newStart += head
+            newEnd += head
+            oldIndex = oldStart
+            newIndex = newStart
+            while oldIndex < oldEnd or newIndex < newEnd:
+                if oldIndex < oldEnd and newIndex < newEnd and \
+                       oldChildren[oldIndex].name == \
+                       newChildren[newIndex].name:
+                    child = oldChildren[oldIndex]
+                    pairs.append(("%s/%s[%d]" % (path, child.name, oldIndex),
+                                  child, newChildren[newIndex]))
+                    oldIndex += 1
+                    newIndex += 1
+                    continue
+                if oldIndex < oldEnd:
+                    child = oldChildren[oldIndex]
+                    differences.append(
+                        (NODE_REMOVED,
+                         "%s/%s[%d]" % (path, child.name, oldIndex),
+                         child, None))
+                    oldIndex += 1
+                if newIndex < newEnd:
+                    child = newChildren[newIndex]
+                    differences.append(
+                        (NODE_ADDED,
+                         "%s/%s[%d]" % (path, child.name, newIndex),
+                         None, child))
+                    newIndex += 1
+        #  //
+        # // Compare the paired children in tree order
+        #//
+        pairs.reverse()
+        stack.extend(pairs)
+    return differences
@@ -16,9 +16,28 @@ from xml.sax import make_parser
 
 #from IMProv.IMProvDoc import IMProvDoc
 #from IMProv.IMProvNode import IMProvNode
+#from IMProv.IMProvCompactNode import IMProvCompactDoc, IMProvCompactNode
+
+#from IMProv.IMProvQuery import compileQuery
+#from IMProv.IMProvUtils import suspendedGC
 
 from  PhysicsTools.HeppyCore.utils.IMProv.IMProvDoc import IMProvDoc
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvNode import IMProvNode
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvCompactNode import IMProvCompactDoc, IMProvCompactNode
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvQuery import compileQuery
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import suspendedGC
+
+
+def _nodeClasses(compact):
+    """
+    _nodeClasses_
+
+    Return the (document, node) classes to build trees from
+
+    """
+    if compact:
+        return IMProvCompactDoc, IMProvCompactNode
+    return IMProvDoc, IMProvNode
 
 
 class IMProvHandler(ContentHandler):
@@ -27,10 +46,14 @@ class IMProvHandler(ContentHandler):
 
     SAX Content Handler implementation to build an
     IMProv Tree from an XML Document
+
+    If compact is True, the tree is built from IMProvCompactNodes
     
     """
-    def __init__(self):
+    def __init__(self, compact = False):
         ContentHandler.__init__(self)
+        self._DocClass, self._NodeClass = _nodeClasses(compact)
+        self._Compact = compact
         self._ParentDoc = None
         self._NodeStack = []
         self._CharCache = ""
@@ -42,16 +65,19 @@ class IMProvHandler(ContentHandler):
         Override SAX startElement handler
         """
         if self._ParentDoc == None:
-            self._ParentDoc = IMProvDoc(str(name))
+            self._ParentDoc = self._DocClass(str(name))
             self._NodeStack.append(self._ParentDoc)
             return
         plainAttrs = {}
         self._CharCache = ""
         for key, value in attrs.items():
             plainAttrs[str(key)] = str(value)
-        newnode = IMProvNode(str(name))
-        for key, value in attrs.items():
-            newnode.attrs[key] = value
+        newnode = self._NodeClass(str(name))
+        if attrs:
+            if self._Compact:
+                newnode.attrs = attrs
+            else:
+                dict.update(newnode.attrs, attrs.items())
         self._NodeStack[-1].addNode(newnode)
         self._NodeStack.append(newnode)
         return
@@ -74,37 +100,207 @@ class IMProvHandler(ContentHandler):
         Accumulate character data from an xml element
         """
         self._CharCache += data
-        
-        
 
-def loadIMProvFile(filename):
+
+
+class IMProvStreamHandler(ContentHandler):
+    """
+    _IMProvStreamHandler_
+
+    SAX Content Handler that only builds the IMProvNode subtrees
+    matching a query path, see iterIMProvFile.
+
+    For each open element the stack holds a tuple of
+    (node, terms, isResult) where node is the IMProvNode being built
+    for the element (None if it is not part of a matching subtree),
+    terms the indexes of the non final query terms the element matches
+    and isResult True if the element may match the whole query.
+    The values of the matching subtrees are appended to results as
+    their elements end
+
+    If compact is True, the subtrees are built from IMProvCompactNodes
+
+    """
+    def __init__(self, query, compact = False):
+        ContentHandler.__init__(self)
+        self._DocClass, self._NodeClass = _nodeClasses(compact)
+        self.results = []
+        self._Terms = compileQuery(query).terms
+        self._Relative = not query.startswith("/")
+        self._Stack = []
+        self._CharCache = []
+
+    def startElement(self, name, attrs):
+        """
+        _startElement_
+
+        Override SAX startElement handler
+        """
+        terms = self._Terms
+        lastIndex = len(terms) - 1
+        del self._CharCache[:]
+        if self._Stack:
+            parent, parentTerms = self._Stack[-1][:2]
+            candidates = [index + 1 for index in parentTerms]
+            if self._Relative:
+                candidates.append(0)
+        else:
+            parent = None
+            candidates = [0]
+        candidates = [index for index in candidates
+                      if terms[index]['Name'] in (name, "*")]
+
+        if parent == None and len(candidates) == 0:
+            #  //
+            # // Not part of a matching subtree: do not keep the node
+            #//
+            self._Stack.append((None, [], False))
+            return
+
+        if len(self._Stack) == 0:
+            #  //
+            # // Document element: no attributes, as in IMProvHandler
+            #//
+            node = self._DocClass(str(name))
+        else:
+            node = self._NodeClass(str(name))
+            if attrs:
+                node.attrs = attrs
+
+        #  //
+        # // Non final terms are evaluated now, on the name and
+        #//  attributes of the element
+        matched = []
+        isResult = False
+        for index in candidates:
+            if index == lastIndex:
+                isResult = True
+            elif terms[index](node):
+                matched.append(index)
+
+        if parent != None:
+            parent.addNode(node)
+        elif not isResult:
+            node = None
+        self._Stack.append((node, matched, isResult))
+        return
+
+    def endElement(self, name):
+        """
+        _endElement_
+
+        Override SAX endElement handler
+        """
+        node, matched, isResult = self._Stack.pop()
+        if node != None:
+            node.chardata = str("".join(self._CharCache).strip())
+        del self._CharCache[:]
+        if isResult:
+            #  //
+            # // The subtree is complete, evaluate the final term
+            #//
+            term = self._Terms[-1]
+            if term(node):
+                value = term.evaluate(node)
+                if value != None:
+                    self.results.append(value)
+        return
+
+    def characters(self, data):
+        """
+        _characters_
+
+        Accumulate character data from an xml element that is kept
+        """
+        if self._Stack and self._Stack[-1][0] != None:
+            self._CharCache.append(data)
+        return
+
+
+
+
+def loadIMProvFile(filename, compact = False):
     """
     _loadIMProvFile_
 
     Load an XML Document into an IMProv Tree
+
+    If compact is True, the tree is made of IMProvCompactNodes, which
+    take several times less memory than IMProvNodes
     """
-    handler = IMProvHandler()
+    handler = IMProvHandler(compact)
     parser = make_parser()
     parser.setContentHandler(handler)
-    parser.parse(filename)
+    with suspendedGC():
+        parser.parse(filename)
     return handler._ParentDoc
 
 
 
-def loadIMProvString(xmlString):
+def loadIMProvString(xmlString, compact = False):
     """
     _loadIMProvString_
 
     Treat string as an XML document and feed it through the parser to
-    create an improv tree
+    create an improv tree, see loadIMProvFile for compact
     """
-    handler = IMProvHandler()
+    handler = IMProvHandler(compact)
     parser = make_parser()
     parser.setContentHandler(handler)
-    parser.feed(xmlString)
-    return handler._ParentDoc
-    
+    with suspendedGC():
+        parser.feed(xmlString)
+    #  //
+    # // The parser is not closed, and is only freed by the cycle
+    #//  collector: do not leave the tree to it
+    document = handler._ParentDoc
+    handler._ParentDoc = None
+    del handler._NodeStack[:]
+    return document
 
 
 
+def iterIMProvFile(filename, query, bufferSize = 65536, compact = False):
+    """
+    _iterIMProvFile_
 
+    Generator yielding the results of the IMProvQuery query on the XML
+    Document in filename (a file name or an open file) as the document
+    is parsed, without building the whole IMProv Tree: only the subtrees
+    matching the query are kept, and only until they are yielded.
+
+    Results are the same values IMProvQuery returns, with two
+    differences:
+
+    - they are yielded as their element ends, so a result nested inside
+      another result comes before it
+    - predicates of the terms before the last one are evaluated on the
+      name and attributes of the element only
+
+    If compact is True, the subtrees are made of IMProvCompactNodes
+
+    """
+    handler = IMProvStreamHandler(query, compact)
+    parser = make_parser()
+    parser.setContentHandler(handler)
+    if hasattr(filename, "read"):
+        handle = filename
+    else:
+        handle = open(filename, 'rb')
+    try:
+        while True:
+            data = handle.read(bufferSize)
+            if not data:
+                break
+            parser.feed(data)
+            if handler.results:
+                results = handler.results
+                handler.results = []
+                for result in results:
+                    yield result
+        parser.close()
+        for result in handler.results:
+            yield result
+    finally:
+        if handle is not filename:
+            handle.close()
+    return
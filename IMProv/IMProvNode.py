@@ -9,68 +9,252 @@ __version__ = "$Revision: 1.1 $"
 __revision__ = "$Id: IMProvNode.py,v 1.1 2006/04/10 17:01:34 evansde Exp $"
 
 
+import copy_reg
+import weakref
 from xml.dom.minidom import Element, Text
 
 #from IMProv.IMProvException import IMProvException
+#from IMProv.IMProvHash import invalidateHash
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvException import IMProvException
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvHash import invalidateHash
 
 
-class IMProvNode(dict):
+#  //
+# // Events of IMProvNodeMethods.iterEvents
+#//
+START_NODE = "startNode"
+END_NODE = "endNode"
+
+#  //
+# // Instance attributes of IMProvNode and IMProvDoc that are not
+#//  pickled: weak references to the parent and document and cached
+#//  indexes/hashes
+_Transient = ("_Doc", "_Parent", "_Hash", "_NameIndex", "_AttributeIndexes")
+
+
+class IMProvAttrs(dict):
     """
-    Node in an IMProv Tree for building a
-    tree based information container of nodes
-    That can be easily converted to and from XML
-    
+    _IMProvAttrs_
+
+    Attribute dictionary of the IMProv nodes, that tells the node it
+    belongs to about its changes once the node watches it (see
+    _WatchAttrs), so that the caches depending on the attributes of
+    the node are dropped.
+    _Node is a weak reference to the node, so that the node and its
+    attributes do not make a reference cycle. It is set to None when
+    the dictionary is made for a node, an unset _Node is only looked
+    up the slow way
+
     """
+    __slots__ = ("_Node",)
 
-    def __init__(self, name, text = None, **attrs):
-        dict.__init__(self)
-        self.name = name
-        self.attrs = attrs
-        self.chardata = str(text)
-        self.children = []
+    def _Changed(self):
+        node = getattr(self, "_Node", None)
+        if node is not None:
+            node = node()
+            if node is not None:
+                node._AttrsChanged()
 
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        try:
+            node = self._Node
+        except AttributeError:
+            return
+        if node is not None:
+            node = node()
+            if node is not None:
+                node._AttrsChanged()
 
-    def addNode(self, node):
-        """
-        _addNode_
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._Changed()
 
-        Add a child node to this node
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._Changed()
 
-        Args --
+    def setdefault(self, key, default = None):
+        if key in self:
+            return dict.__getitem__(self, key)
+        dict.__setitem__(self, key, default)
+        self._Changed()
+        return default
 
-        - *node* : Instance of IMProvNode to be added
-        as child
-        """
-        if not isinstance(node, IMProvNode):
-            msg = "Value is not an IMProvNode instance"
-            raise IMProvException(
-                msg, ClassInstance = self,
-                Value = node)
-        
-        self.children.append(node)
-        self[node.name] = node
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        self._Changed()
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._Changed()
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        self._Changed()
+
+    def __reduce__(self):
+        #  //
+        # // Without the node, see IMProvNode._Transient
+        #//
+        return self.__class__, (dict(self),)
+
+
+class _AttrsDescriptor(object):
+    """
+    _AttrsDescriptor_
+
+    attrs of IMProvNode: setting it stores a copy of the attributes
+    as an IMProvAttrs in the instance dictionary and tells the node.
+    There is no __get__, so reading attrs is a plain instance
+    dictionary lookup
+
+    """
+    def __set__(self, node, attrs):
+        attrs = IMProvAttrs(attrs)
+        attrs._Node = None
+        node.__dict__["attrs"] = attrs
+        node._AttrsChanged()
+
+
+#  //
+# // Number of levels processNodes and improvOperator recurse through,
+#//  the deeper subtrees are traversed with an explicit stack
+_RecursionDepth = 200
+
+
+def _processChildren(children, callback, depth):
+    """
+    _processChildren_
+
+    Call callback on the nodes of the subtrees of children in tree
+    order, recursing for depth more levels. Leaves are handled
+    without a call, deeper subtrees with a stack of child iterators
+    """
+    if depth:
+        depth -= 1
+        for node in children:
+            callback(node)
+            grandChildren = node.children
+            if grandChildren:
+                _processChildren(grandChildren, callback, depth)
         return
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    current = iter(children)
+    while True:
+        for node in current:
+            callback(node)
+            grandChildren = node.children
+            if grandChildren:
+                push(current)
+                current = iter(grandChildren)
+                break
+        else:
+            if not stack:
+                return
+            current = pop()
 
-        
-    def __setitem__(self, key, value):
-        if not self.has_key(key):
-            dict.__setitem__(self, key, [])
-        self[key].append(value)
+
+def _operateChildren(children, startNode, endNode, depth):
+    """
+    _operateChildren_
+
+    Call startNode and endNode on the nodes of the subtrees of children
+    in tree order, as _processChildren does
+    """
+    if depth:
+        depth -= 1
+        for node in children:
+            startNode(node.name, node)
+            grandChildren = node.children
+            if grandChildren:
+                _operateChildren(grandChildren, startNode, endNode, depth)
+            endNode(node.name, node)
         return
+    #  //
+    # // (node, iterator over its children) of the open nodes
+    #//
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    parent = None
+    current = iter(children)
+    while True:
+        for node in current:
+            startNode(node.name, node)
+            grandChildren = node.children
+            if grandChildren:
+                push((parent, current))
+                parent = node
+                current = iter(grandChildren)
+                break
+            endNode(node.name, node)
+        else:
+            if not stack:
+                return
+            endNode(parent.name, parent)
+            parent, current = pop()
+
+
+class IMProvNodeMethods(object):
+    """
+    _IMProvNodeMethods_
 
+    Traversal and serialisation methods shared by the IMProv node
+    types, which provide the name, attrs, chardata and children
+    of the node
+
+    """
+    __slots__ = ()
+
+    def _AttrsChanged(self):
+        """
+        _AttrsChanged_
+
+        Called when the attributes of the node change, drop the
+        structural hash of the node and the attribute indexes of its
+        document that may include it
+        """
+        if self._Hash is not None:
+            invalidateHash(self)
+        if self._Doc is not None:
+            doc = self._Doc()
+            if doc is not None and doc._AttributeIndexes:
+                doc._DropAttributeIndexes(self.name)
+        return
+
+    def _ChildrenChanged(self):
+        """
+        _ChildrenChanged_
+
+        Called when children are added to the node, drop the structural
+        hash of the node and the name index of its document
+        """
+        if self._Hash is not None:
+            invalidateHash(self)
+        if self._Doc is not None:
+            doc = self._Doc()
+            if doc is not None:
+                doc.dropNameIndex()
+        return
 
     def processNodes(self, callback):
         """
         _processNodes_
 
         execute the callback provided on every node in the node tree,
-        starting with this node. Traversal is recursive tree descent
-        much like SAX
+        starting with this node. Traversal is tree descent much like
+        SAX, recursive down to _RecursionDepth levels and with a stack
+        below, so that there is no limit on the depth of the tree
         """
         callback(self)
-        for node in self.children:
-            node.processNodes(callback)
+        children = self.children
+        if children:
+            _processChildren(children, callback, _RecursionDepth)
         return
 
     def improvOperator(self, operator):
@@ -81,10 +265,61 @@ class IMProvNode(dict):
         and provide the appropriate callbacks
 
         """
-        operator.startNode(self.name, self)
-        for node in self.children:
-            node.improvOperator(operator)
-        operator.endNode(self.name, self)
+        startNode = operator.startNode
+        endNode = operator.endNode
+        startNode(self.name, self)
+        children = self.children
+        if children:
+            _operateChildren(children, startNode, endNode, _RecursionDepth)
+        endNode(self.name, self)
+        return
+
+    def iterNodes(self):
+        """
+        _iterNodes_
+
+        Generator over this node and all its descendants, in the order
+        processNodes visits them. Stop iterating to end the traversal
+
+        """
+        yield self
+        stack = [iter(self.children)]
+        push = stack.append
+        while stack:
+            for node in stack[-1]:
+                yield node
+                children = node.children
+                if children:
+                    push(iter(children))
+                    break
+            else:
+                stack.pop()
+        return
+
+    def iterEvents(self):
+        """
+        _iterEvents_
+
+        Generator of (event, node) over the tree, event being
+        START_NODE or END_NODE, in the order of the startNode and
+        endNode calls of improvOperator
+
+        """
+        yield START_NODE, self
+        stack = [(self, iter(self.children))]
+        push = stack.append
+        while stack:
+            parent, siblings = stack[-1]
+            for node in siblings:
+                yield START_NODE, node
+                children = node.children
+                if children:
+                    push((node, iter(children)))
+                    break
+                yield END_NODE, node
+            else:
+                stack.pop()
+                yield END_NODE, parent
         return
     
 
@@ -125,21 +360,140 @@ class IMProvNode(dict):
         return textElem
 
     def __str__(self):
-        """create string rep of self"""
-        strg = '<%s' % self.name
-        for key, value in self.attrs.items():
-            strg += ' %s=\"%s\" ' % (key, value)
-        strg += '>\n'
-        if self.chardata not in (None, str(None) ):
-            lines = self.chardata.splitlines()
-            for line in lines:
-                strg += "  %s\n" % line
-        for value in self.children:
-            strgRep = str(value)
-            lines = strgRep.splitlines()
-            for line in lines:
-                strg += "  %s\n" % line
-        strg += "</%s>\n" % self.name
-        return strg
+        """
+        create string rep of self
+
+        Each level of the tree is indented by two more spaces, the
+        nodes below this one having their lines split (as they were
+        when the children were converted with str() and re-indented
+        line by line)
+        """
+        strg = []
+        #  //
+        # // (indent, node) for the nodes to write, and
+        #//  (indent, line) for their closing tags
+        stack = [("", self)]
+        while stack:
+            indent, node = stack.pop()
+            if not isinstance(node, IMProvNodeMethods):
+                strg.append(node)
+                continue
+            header = '<%s' % node.name
+            for key, value in node.attrs.items():
+                header += ' %s=\"%s\" ' % (key, value)
+            header += '>\n'
+            if not indent:
+                strg.append(header)
+            else:
+                for line in str(header).splitlines():
+                    strg.append("%s%s\n" % (indent, line))
+            if node.chardata not in (None, str(None) ):
+                lines = node.chardata.splitlines()
+                for line in lines:
+                    strg.append("%s  %s\n" % (indent, line))
+            stack.append((indent, "%s</%s>\n" % (indent, node.name)))
+            for child in reversed(node.children):
+                stack.append(("%s  " % indent, child))
+        return "".join(strg)
+
+
+class IMProvNode(IMProvNodeMethods, dict):
+    """
+    Node in an IMProv Tree for building a
+    tree based information container of nodes
+    That can be easily converted to and from XML
+
+    Nodes are pickled and copied without their reference to the
+    document and their cached hashes (see _Transient), so that a
+    subtree does not drag in its document and indexes
+    
+    """
+    #  //
+    # // Weak reference to the document whose name index includes this
+    #//  node, see IMProvNameIndex
+    _Doc = None
+    #  //
+    # // Structural hash cached by IMProvHash, and the weak reference
+    #//  (or tuple of them) to the parents it found the node under
+    _Hash = None
+    _Parent = None
+
+    attrs = _AttrsDescriptor()
+
+    def __init__(self, name, text = None, **attrs):
+        dict.__init__(self)
+        self.name = name
+        if attrs:
+            attrs = self.__dict__["attrs"] = IMProvAttrs(attrs)
+        else:
+            attrs = self.__dict__["attrs"] = IMProvAttrs()
+        attrs._Node = None
+        self.chardata = str(text)
+        self.children = []
+
+
+    def addNode(self, node):
+        """
+        _addNode_
+
+        Add a child node to this node
+
+        Args --
+
+        - *node* : Instance of IMProvNode (or IMProvCompactNode) to be
+        added as child
+        """
+        if not isinstance(node, IMProvNodeMethods):
+            msg = "Value is not an IMProvNode instance"
+            raise IMProvException(
+                msg, ClassInstance = self,
+                Value = node)
+        
+        self.children.append(node)
+        self[node.name] = node
+        if self._Doc is not None or self._Hash is not None:
+            self._ChildrenChanged()
+        return
+
+
+    def _WatchAttrs(self):
+        """
+        _WatchAttrs_
+
+        Return the attributes of the node, making their changes call
+        _AttrsChanged from now on
+        """
+        attrs = self.attrs
+        attrs._Node = weakref.ref(self)
+        return attrs
+
+        
+    def __setitem__(self, key, value):
+        if not self.has_key(key):
+            dict.__setitem__(self, key, [])
+        self[key].append(value)
+        return
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in _Transient:
+            state.pop(name, None)
+        return state, dict(self)
+
+    def __setstate__(self, state):
+        state, items = state
+        self.__dict__.update(state)
+        dict.update(self, items)
+        attrs = self.__dict__.get("attrs", None)
+        if attrs is not None:
+            attrs = self.__dict__["attrs"] = IMProvAttrs(attrs)
+            attrs._Node = None
+
+    def __reduce_ex__(self, protocol):
+        #  //
+        # // The name : children lists are restored with dict.update,
+        #//  not through __setitem__ which would nest them in lists
+        return copy_reg.__newobj__, (self.__class__,), self.__getstate__()
         
     
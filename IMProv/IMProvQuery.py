@@ -11,11 +11,17 @@ __revision__ = "$Id: IMProvQuery.py,v 1.1 2006/04/10 17:01:34 evansde Exp $"
 
 
 import re
-#from IMProv.Predicates import parsePredicate
+from operator import itemgetter
+from itertools import count, islice, chain
+#from IMProv.Predicates import parsePredicate, compilePredicate
+#from IMProv.Predicates import attributeEquality
 #from IMProv.IMProvException import IMProvException
+#from IMProv.IMProvDoc import IMProvNameIndex
 
-from PhysicsTools.HeppyCore.utils.IMProv.Predicates import parsePredicate
+from PhysicsTools.HeppyCore.utils.IMProv.Predicates import parsePredicate, compilePredicate
+from PhysicsTools.HeppyCore.utils.IMProv.Predicates import attributeEquality
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvException import IMProvException
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvDoc import IMProvNameIndex
 
 _MatchPredicate = re.compile("^[\S]+\[[\S]+\]$")
 
@@ -29,6 +35,7 @@ class QueryTerm(dict):
         self.setdefault("Term", queryTerm)
         self.setdefault("Name", None)
         self.setdefault("Predicate", None)
+        self.setdefault("AttributeEquality", None)
         self.setdefault("LastTerm", False)
         self.parse()
 
@@ -45,7 +52,9 @@ class QueryTerm(dict):
             predStr = '[%s' % termSplit[1]
             self['Name'] = termSplit[0]
             try:
-                self['Predicate'] = parsePredicate(predStr) 
+                predicate = parsePredicate(predStr)
+                self['AttributeEquality'] = attributeEquality(predicate)
+                self['Predicate'] = compilePredicate(predicate)
             except IMProvException, ex:
                 ex.addInfo(BadTerm = self['Term'])
                 raise ex
@@ -111,7 +120,379 @@ class QueryTerm(dict):
         if result == True:
             result = node
         return result
-        
+
+
+def parseQueryTerms(query):
+    """
+    _parseQueryTerms_
+
+    Chop a query up into the list of QueryTerms for its path
+    components, the last one having its LastTerm flag set
+
+    """
+    qlist = query.split('/')
+    while "" in qlist:
+        qlist.remove("")
+    terms = [QueryTerm(item) for item in qlist]
+    terms[-1]['LastTerm'] = True
+    return terms
+
+
+class CompiledQuery:
+    """
+    _CompiledQuery_
+
+    Execution plan for a query, see IMProvQuery for the query syntax.
+
+    A CompiledQuery is not modified once built and keeps no state
+    between calls, so the same instance can be run on any number of
+    nodes, from several threads. Use compileQuery to get the shared
+    instance for a query string
+
+    """
+    def __init__(self, query):
+        self.query = query
+        self.terms = tuple(parseQueryTerms(query))
+        self.relative = not query.startswith("/")
+        #  //
+        # // (name, predicate) for each term, name None for wildcards
+        #//
+        steps = []
+        for term in self.terms:
+            name = term['Name']
+            if name == "*":
+                name = None
+            steps.append((name, term['Predicate']))
+        self._Steps = tuple(steps)
+        self._LastIndex = len(steps) - 1
+        #  //
+        # // (attribute name, value) if the first term tests
+        #//  attribute("name")==value, see IMProvNameIndex.indexAttribute
+        self._StartEquality = self.terms[0]['AttributeEquality']
+
+
+    def __call__(self, improvNode, limit = None):
+        """
+        _operator()_
+
+        Execute the query on the node structure provided, assuming
+        improvNode is the top level node (ie it will be treated as
+        / in the query), and return the list of results.
+
+        If limit is provided, the traversal stops once limit
+        results have been found
+        """
+        if limit is not None:
+            return list(islice(self.iterate(improvNode), limit))
+        results = []
+        if self.relative:
+            for node in self._StartNodes(improvNode):
+                self._Match(node, 0, results)
+        else:
+            self._Match(improvNode, 0, results)
+        return results
+
+
+    def first(self, improvNode, default = None):
+        """
+        _first_
+
+        Return the first result of the query on the node structure
+        provided, or default if there are none, stopping the
+        traversal at the first match
+        """
+        for value in self.iterate(improvNode):
+            return value
+        return default
+
+
+    def iterate(self, improvNode):
+        """
+        _iterate_
+
+        Generator yielding the results of the query on the node
+        structure provided one at a time, in the same order as
+        __call__. The tree is traversed as the results are consumed,
+        so it should not be modified until the iteration is over
+        """
+        if self.relative:
+            starts = self._StartNodes(improvNode)
+        else:
+            starts = (improvNode,)
+        steps = self._Steps
+        lastIndex = self._LastIndex
+        for start in starts:
+            #  //
+            # // (iterator over the nodes still to be matched, index of
+            #//  the term they are matched against)
+            stack = [(iter((start,)), 0)]
+            while stack:
+                nodes, index = stack[-1]
+                for node in nodes:
+                    break
+                else:
+                    stack.pop()
+                    continue
+                name, predicate = steps[index]
+                if name is not None and node.name != name:
+                    continue
+                if index == lastIndex:
+                    if predicate is None:
+                        yield node
+                        continue
+                    value = predicate(node)
+                    if value == True:
+                        yield node
+                    elif value != False and value != None:
+                        yield value
+                    continue
+                if predicate is not None and predicate(node) != True:
+                    continue
+                children = node.children
+                if children:
+                    stack.append((iter(children), index + 1))
+        return
+
+
+    def _StartNodes(self, improvNode):
+        """
+        _StartNodes_
+
+        Return the nodes a relative query is matched from, in tree order
+        """
+        if not isinstance(improvNode, IMProvNameIndex):
+            #  //
+            # // Every node in the tree is a potential start node
+            #//
+            return improvNode.iterNodes()
+        #  //
+        # // Start from the nodes of the document matching
+        #//  the name of the first term
+        name = self._Steps[0][0] or "*"
+        nodes = None
+        if self._StartEquality is not None:
+            #  //
+            # // Only the nodes with the attribute value can match
+            #//  if the document has an index for it
+            attr, value = self._StartEquality
+            index = improvNode.attributeIndex(name, attr)
+            if index is not None:
+                nodes = index.get(value, ())
+        if nodes is None:
+            nodes = improvNode.nameIndex().get(name, ())
+        if name != "*" and improvNode.name != name:
+            return nodes
+        #  //
+        # // The indexes do not include the document, _Match checks
+        #//  the predicate of the first term on it
+        return chain((improvNode,), nodes)
+
+
+    def _Match(self, node, index, results):
+        """
+        _Match_
+
+        Match the terms of the query from index onwards against node and
+        its descendants, adding the value of each match to results
+        """
+        name, predicate = self._Steps[index]
+        if name is not None and node.name != name:
+            return
+        if index == self._LastIndex:
+            #  //
+            # // Match and evaluate the last term in one go, the value
+            #//  of a True predicate is the node itself
+            if predicate is None:
+                results.append(node)
+                return
+            value = predicate(node)
+            if value == True:
+                results.append(node)
+            elif value != False and value != None:
+                results.append(value)
+            return
+        if predicate is not None and predicate(node) != True:
+            return
+        index += 1
+        for child in node.children:
+            self._Match(child, index, results)
+        return
+
+
+#  //
+# // Shared CompiledQuery instances, keyed on the query string
+#//
+_CompiledQueries = {}
+_CompiledQueriesLimit = 1024
+
+def compileQuery(query):
+    """
+    _compileQuery_
+
+    Return the CompiledQuery for the query string provided, queries are
+    only parsed the first time they are seen.
+
+    Raises IMProvException if the query cannot be parsed
+
+    """
+    plan = _CompiledQueries.get(query, None)
+    if plan == None:
+        plan = CompiledQuery(query)
+        if len(_CompiledQueries) >= _CompiledQueriesLimit:
+            _CompiledQueries.clear()
+        _CompiledQueries[query] = plan
+    return plan
+
+
+
+class QuerySet:
+    """
+    _QuerySet_
+
+    Set of queries evaluated together in a single traversal of an
+    IMProv tree.
+
+    The terms of the queries are the states of an automaton: each node
+    of the tree is visited once with the states its ancestors moved
+    to, plus the first state of the relative queries whose first
+    term has the name of the node. The node is matched against the
+    term of each state, and the states it matches hand the next term
+    of their query down to the children of the node.
+
+    Calling a QuerySet on a node returns a dictionary of
+    query string : results, the results of each query being the same,
+    in the same order, as those of IMProvQuery for that query
+
+    """
+    def __init__(self, queries = ()):
+        self.queries = []
+        self._Plans = []
+        self._Absolute = []
+        self._Relative = {}
+        self._RelativeAll = []
+        for query in queries:
+            self.addQuery(query)
+
+
+    def addQuery(self, query):
+        """
+        _addQuery_
+
+        Register a query string, queries already in the set are
+        ignored.
+
+        Raises IMProvException if the query cannot be parsed
+
+        """
+        if query in self.queries:
+            return
+        plan = compileQuery(query)
+        planIndex = len(self._Plans)
+        #  //
+        # // The state of each term is (name, predicate, query index,
+        #//  state of the next term), None after the last term
+        first = None
+        for name, predicate in reversed(plan._Steps):
+            first = (name, predicate, planIndex, first)
+        self.queries.append(query)
+        self._Plans.append(plan)
+
+        name = plan._Steps[0][0]
+        if not plan.relative:
+            self._Absolute.append(first)
+        elif name is None:
+            self._RelativeAll.append(first)
+        else:
+            self._Relative.setdefault(name, []).append(first)
+        return
+
+
+    def __call__(self, improvNode):
+        """
+        _operator()_
+
+        Execute all the queries on the node structure provided, with
+        improvNode as the top level node, and return the dictionary of
+        query string : list of results
+        """
+        relativeAll = self._RelativeAll
+        startStates = {}
+        for name, starts in self._Relative.items():
+            startStates[name] = starts + relativeAll
+        walkAll = bool(startStates or relativeAll)
+        #  //
+        # // (start, value) for each query, relative queries are
+        #//  numbered in the order of their start nodes in the tree
+        matches = [[] for plan in self._Plans]
+
+        nextStart = count(1).next
+        noStates = []
+
+        #  //
+        # // Stack of (children iterator, states handed down by their
+        #//  parent), the top level node being the only child of None
+        stack = [(iter((improvNode,)),
+                  [(state, 0) for state in self._Absolute])]
+        while stack:
+            children, inherited = stack[-1]
+            for node in children:
+                name = node.name
+                active = inherited
+                if walkAll:
+                    starts = startStates.get(name, relativeAll)
+                    if starts:
+                        start = nextStart()
+                        active = active + [(state, start)
+                                           for state in starts]
+                if not active:
+                    #  //
+                    # // Nothing to match here, the nodes below may
+                    #//  still start relative queries
+                    if walkAll and node.children:
+                        stack.append((iter(node.children), noStates))
+                        break
+                    continue
+                forward = []
+                for state, start in active:
+                    stepName, predicate, planIndex, nextState = state
+                    if stepName is not None and stepName != name:
+                        continue
+                    if nextState is None:
+                        #  //
+                        # // Last term, the value of a True predicate is
+                        #//  the node itself
+                        if predicate is None:
+                            matches[planIndex].append((start, node))
+                            continue
+                        value = predicate(node)
+                        if value == True:
+                            matches[planIndex].append((start, node))
+                        elif value != False and value != None:
+                            matches[planIndex].append((start, value))
+                        continue
+                    if predicate is not None and predicate(node) != True:
+                        continue
+                    forward.append((nextState, start))
+                if (forward or walkAll) and node.children:
+                    stack.append((iter(node.children), forward))
+                    break
+            else:
+                stack.pop()
+
+        results = {}
+        for planIndex, plan in enumerate(self._Plans):
+            planMatches = matches[planIndex]
+            if plan.relative:
+                #  //
+                # // IMProvQuery returns the results grouped by start
+                #//  node, the sort is stable so each group stays in
+                #  //tree order
+                planMatches.sort(key = itemgetter(0))
+            results[plan.query] = [value for start, value in planMatches]
+        return results
+
+
+
 class IMProvQuery:
     """
     _IMProvQuery_
@@ -123,73 +504,63 @@ class IMProvQuery:
     structure.
     
     Also provides a container for retrieving matching results
+
+    The query is executed by the shared CompiledQuery for the query
+    string (see compileQuery), calls do not keep any results.
+    findRelativeNodes and processNodeQuery are kept for compatibility,
+    and accumulate their matches in nodeCache and results
     
     """
    
     
     def __init__(self, query):
         self._Query = query
-        self._QueryTerms = []
-        self._ParseQuery()
+        self._Plan = compileQuery(query)
+        self._QueryTerms = list(self._Plan.terms)
         self.results = []
         self.nodeCache = []
         
-    def __call__(self, improvNode):
+    def __call__(self, improvNode, limit = None):
         """
         _operator()_
 
         Execute the query on the node structure provided, assuming
         improvNode is the top level node (ie it will be treated as
-        / in the query
+        / in the query, returning at most limit results if provided
         """
-        if self._Query.startswith("/"):
-            #  //
-            # // Query from Root Node
-            #//  add root node to the nodeCache
-            self.nodeCache.append(improvNode)
-        else:
-            #  //
-            # // Relative nodes, find all nodes that match the
-            #//  first term in the query
-            self.findRelativeNodes(improvNode)
+        return self._Plan(improvNode, limit)
 
-        #  //
-        # // nodeCache now contains the list of nodes to evaluate
-        #//  the query on
-        #print self.nodeCache
-        #  // 
-        # // Now recursively execute the query on each of the nodes
-        #//  in the cache to search for matches. Matches will be
-        #  //added to the results cache and the final results
-        # // are used to evaluate the result values
-        #//
-        termlist = self._QueryTerms[:]
-        for node in self.nodeCache:
-            self.processNodeQuery(node, termlist)
 
-    
-        lastTerm = self._QueryTerms[-1]
-        returnResults = []
-        for result in self.results:
-            value = lastTerm.evaluate(result)
-            if value != None:
-                returnResults.append(value)
-        return returnResults
+    def first(self, improvNode, default = None):
+        """
+        _first_
+
+        Return the first result of the query on the node structure
+        provided, or default if there are none
+        """
+        return self._Plan.first(improvNode, default)
+
+
+    def iterate(self, improvNode):
+        """
+        _iterate_
+
+        Iterate over the results of the query on the node structure
+        provided, finding them as they are consumed
+        """
+        return self._Plan.iterate(improvNode)
     
     
 
-
     def findRelativeNodes(self, node):
         """
         process the whole node tree to find all nodes that
         match the first query Term.
-        Recursively process all child nodes.
         """
         firstTerm = self._QueryTerms[0]
-        if firstTerm(node):
-            self.nodeCache.append(node)
-        for child in node.children:
-            self.findRelativeNodes(child)
+        for current in node.iterNodes():
+            if firstTerm(current):
+                self.nodeCache.append(current)
         return
     
 
@@ -208,56 +579,35 @@ class IMProvQuery:
             # // No Terms => No matches
             #//
             return
-        firstTerm = terms[0]
-        if not firstTerm(improvNode):
-            #  //
-            # // No match between node name and first term
-            #//  => No matches on this node
-            return
-        
         #  //
-        # // Have a node match, if there are still terms, then
-        #//  reduce the query, by removing this nodes name and
-        #  //and then apply it to the children of the matched node
-        # // If there are no more terms, then we have a match to the
-        #//  end of the query, so keep a reference to it
-        newterms = terms[1:]
-        if len(newterms) == 0:
-            #  //
-            # // No terms => match made, keep ref to node in results
-            #//
-            self.results.append(improvNode)
-            return
-        for child in improvNode.children:
-            #  //
-            # // more terms => act recursively on children
-            #//
-            self.processNodeQuery(child, newterms)
-        return
-        
-
-        
-
-        
-
-
+        # // (node, terms) still to be matched, in tree order
+        #//
+        stack = [(improvNode, terms)]
+        while stack:
+            node, terms = stack.pop()
+            firstTerm = terms[0]
+            if not firstTerm(node):
+                #  //
+                # // No match between node name and first term
+                #//  => No matches on this node
+                continue
         
-    
-    def _ParseQuery(self):
-        """
-        _ParseQuery_
-
-        Chop the query up into a stack of terms
-
-        """
-        qlist = self._Query.split('/')
-        while "" in qlist:
-            qlist.remove("")
-        for item in qlist:
-            self._QueryTerms.append(QueryTerm(item))
-        self._QueryTerms[-1]['LastTerm'] = True
+            #  //
+            # // Have a node match, if there are still terms, then
+            #//  reduce the query, by removing this nodes name and
+            #  //and then apply it to the children of the matched node
+            # // If there are no more terms, then we have a match to the
+            #//  end of the query, so keep a reference to it
+            newterms = terms[1:]
+            if len(newterms) == 0:
+                #  //
+                # // No terms => match made, keep ref to node in results
+                #//
+                self.results.append(node)
+                continue
+            for child in reversed(node.children):
+                #  //
+                # // more terms => act on children
+                #//
+                stack.append((child, newterms))
         return
-
-
-    
-
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+_IMProvUtils_
+
+Helpers shared by the IMProv loaders and caches and by the
+TrivialFileCatalog snapshots:
+
+- suspendedGC, to build large trees without garbage collections
+- fileDigest and contentDigest, md5 digests of files
+- writeMarshalled, to write marshalled cache files atomically
+
+"""
+
+import os
+import gc
+import marshal
+import tempfile
+import hashlib
+from contextlib import contextmanager
+
+
+@contextmanager
+def suspendedGC():
+    """
+    _suspendedGC_
+
+    Context manager suspending the cyclic garbage collector, if it is
+    enabled, for the duration of the block.
+
+    Allocating millions of nodes, or of index and hash entries, would
+    otherwise trigger full collections over an ever growing heap,
+    while the objects allocated are not garbage
+
+    """
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def contentDigest(content):
+    """
+    _contentDigest_
+
+    md5 hex digest of the string content
+
+    """
+    return hashlib.md5(content).hexdigest()
+
+
+def fileDigest(filename):
+    """
+    _fileDigest_
+
+    md5 hex digest of the content of filename
+
+    """
+    handle = open(filename, 'rb')
+    try:
+        return contentDigest(handle.read())
+    finally:
+        handle.close()
+
+
+def writeMarshalled(target, objects):
+    """
+    _writeMarshalled_
+
+    Marshal the objects one after the other into the file target.
+
+    The file is written to a temporary file in the same directory and
+    renamed, so that concurrent readers never see a partial file.
+    Returns True if the file was written, False if it could not be
+
+    """
+    try:
+        handle, tempName = tempfile.mkstemp(
+            dir = os.path.dirname(target) or ".",
+            prefix = ".%s." % os.path.basename(target))
+    except (IOError, OSError):
+        return False
+    try:
+        stream = os.fdopen(handle, 'wb')
+        try:
+            for value in objects:
+                marshal.dump(value, stream)
+        finally:
+            stream.close()
+        os.chmod(tempName, 0644)
+        os.rename(tempName, target)
+    except (IOError, OSError, ValueError):
+        try:
+            os.remove(tempName)
+        except OSError:
+            pass
+        return False
+    return True
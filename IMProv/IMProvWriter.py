@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+_IMProvWriter_
+
+Streaming XML serialisation of IMProv trees.
+
+IMProvWriter writes a tree straight to a file object, without building
+a DOM tree or the whole document in memory: the output is buffered in
+chunks of bufferSize characters and the tree is traversed with a stack
+of child iterators, so the extra memory needed does not depend on the
+size of the document.
+
+The output is the same as the toprettyxml (or toxml when pretty is
+False) output of makeDOMElement for a node, or of makeDOMDocument
+for a document:
+
+- attributes are written in sorted order, values converted with str()
+- each line of chardata is a separate text node, written on its own
+  line unless it is the only content of the element
+- elements without content are closed with />
+- &, <, > and " are escaped in text and attribute values
+
+"""
+
+#  //
+# // Characters escaped by minidom, in the order they are replaced
+#//
+_Escapes = (("&", "&amp;"), ("<", "&lt;"), ("\"", "&quot;"), (">", "&gt;"))
+
+
+def escapeXML(data):
+    """
+    _escapeXML_
+
+    Escape text or an attribute value as minidom does
+
+    """
+    for char, entity in _Escapes:
+        if char in data:
+            data = data.replace(char, entity)
+    return data
+
+
+class IMProvWriter:
+    """
+    _IMProvWriter_
+
+    Write IMProv trees as XML to a file object (anything with a write
+    method), see module docs.
+
+    Call flush, or close to also close the file, once done writing
+
+    """
+    def __init__(self, handle, pretty = True, indent = "\t", newl = "\n",
+                 bufferSize = 65536):
+        self.handle = handle
+        if pretty:
+            self.indent = indent
+            self.newl = newl
+        else:
+            self.indent = ""
+            self.newl = ""
+        self.bufferSize = bufferSize
+        self._Buffer = []
+        self._BufferLength = 0
+
+
+    def write(self, data):
+        """
+        _write_
+
+        Add data to the output buffer, writing the buffer to the file
+        when it is full
+        """
+        self._Buffer.append(data)
+        self._BufferLength += len(data)
+        if self._BufferLength >= self.bufferSize:
+            self.flush()
+        return
+
+
+    def flush(self):
+        """
+        _flush_
+
+        Write the content of the buffer to the file
+        """
+        if self._Buffer:
+            self.handle.write("".join(self._Buffer))
+            self._Buffer = []
+            self._BufferLength = 0
+        return
+
+
+    def close(self):
+        """
+        _close_
+
+        Flush the buffer and close the file
+        """
+        self.flush()
+        self.handle.close()
+        return
+
+
+    def writeDocument(self, improvNode):
+        """
+        _writeDocument_
+
+        Write the XML declaration followed by the node, the output of
+        makeDOMDocument for an IMProvDoc
+        """
+        self.write('<?xml version="1.0" ?>' + self.newl)
+        self.writeNode(improvNode)
+        return
+
+
+    def writeNode(self, improvNode):
+        """
+        _writeNode_
+
+        Write the node and its children, the output of makeDOMElement
+        """
+        write = self.write
+        newl = self.newl
+        #  //
+        # // (node, indent, iterator over the children) for each
+        #//  element with children still to be written
+        stack = []
+        node = improvNode
+        indent = ""
+        while True:
+            if node is not None:
+                children = self._WriteStart(node, indent)
+                if children is not None:
+                    stack.append((node, indent, iter(children)))
+            if not stack:
+                break
+            parent, parentIndent, children = stack[-1]
+            for node in children:
+                indent = parentIndent + self.indent
+                break
+            else:
+                #  //
+                # // All children written, close the element
+                #//
+                stack.pop()
+                write("%s</%s>%s" % (parentIndent, parent.name, newl))
+                node = None
+        return
+
+
+    def _WriteStart(self, node, indent):
+        """
+        _WriteStart_
+
+        Write the start tag and text of an element, and the end tag if
+        it has no children.
+        Returns the children still to be written, or None if the
+        element is complete
+        """
+        write = self.write
+        newl = self.newl
+        #  //
+        # // Convert the attribute values as makeDOMElement does
+        #//
+        attrs = {}
+        for attr, value in node.attrs.items():
+            attrs[attr] = str(value)
+        lines = ()
+        chardata = node.chardata
+        if chardata not in (None, str(None)):
+            lines = chardata.splitlines()
+        children = node.children
+
+        write("%s<%s" % (indent, node.name))
+        names = attrs.keys()
+        names.sort()
+        for name in names:
+            write(" %s=\"" % name)
+            write(escapeXML(attrs[name]))
+            write("\"")
+
+        if not lines and not children:
+            write("/>%s" % newl)
+            return None
+        write(">")
+        if len(lines) == 1 and not children:
+            write(escapeXML(lines[0]))
+            write("</%s>%s" % (node.name, newl))
+            return None
+        write(newl)
+        textIndent = indent + self.indent
+        for line in lines:
+            write(escapeXML("%s%s%s" % (textIndent, line, newl)))
+        if not children:
+            write("%s</%s>%s" % (indent, node.name, newl))
+            return None
+        return children
+
+
+
+def writeIMProvFile(improvNode, target, pretty = True, document = False):
+    """
+    _writeIMProvFile_
+
+    Write the IMProv tree to target, a file name or an open file,
+    with an XML declaration if document is True
+
+    """
+    if hasattr(target, "write"):
+        handle = target
+    else:
+        handle = open(target, 'w')
+    writer = IMProvWriter(handle, pretty)
+    try:
+        if document:
+            writer.writeDocument(improvNode)
+        else:
+            writer.writeNode(improvNode)
+        writer.flush()
+    finally:
+        if handle is not target:
+            handle.close()
+    return
@@ -19,10 +19,14 @@ import StringIO
 #from IMProv.IMProvException import IMProvException
 #from IMProv.PredicateFunctions import PredicateFunctions
 #from IMProv.PredicateOperators import PredicateOperators
+#from IMProv.PredicateOperators import logicalAnd, logicalOr, equalsOperator
+#from IMProv.PredicateFunctions import attribute
 
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvException import IMProvException
 from PhysicsTools.HeppyCore.utils.IMProv.PredicateFunctions import PredicateFunctions
 from PhysicsTools.HeppyCore.utils.IMProv.PredicateOperators import PredicateOperators
+from PhysicsTools.HeppyCore.utils.IMProv.PredicateOperators import logicalAnd, logicalOr, equalsOperator
+from PhysicsTools.HeppyCore.utils.IMProv.PredicateFunctions import attribute
 
     
 class ExpressionParser:
@@ -300,10 +304,10 @@ class ExprNode:
         Add a value to this operator, if lhs not set, then
         set the lhs to be the value, else, set the rhs
         """
-        if self.leftHandSide == None:
+        if self.leftHandSide is None:
             self.leftHandSide = value
             return
-        elif self.rightHandSide == None:
+        elif self.rightHandSide is None:
             self.rightHandSide = value
             return
 
@@ -530,6 +534,214 @@ class GlyphParser:
 
   
 
+class PredicateParser(GlyphParser):
+    """
+    _PredicateParser_
+
+    Single pass replacement for ExpressionParser and GlyphParser.
+
+    tokenize scans the expression string once, splitting it into
+    glyphs with the same rules as the shlex based ExpressionParser,
+    reduceGlyphs classifies each glyph once and reduces the glyphs to
+    terms in a single loop, reporting the same errors as GlyphParser.
+    The ExprNode tree built from the terms is the same as the one
+    built by GlyphParser
+
+    """
+    _OperatorChars = frozenset("=!><&|")
+    _Operators = frozenset(("==", "!=", ">=", "<=", "&&", "||"))
+    #  //
+    # // The next token after the whitespace: a quoted string, a word
+    #//  starting with a word character, or any other single character.
+    #  //
+    # // As in shlex, quotes do not start a quoted string in the
+    #//  middle of a word
+    _MatchToken = re.compile("[ \t\r\n]*(?:"
+                             "(\"[^\"]*\"|'[^']*')|"
+                             "([a-zA-Z0-9_][a-zA-Z0-9_\"']*)|"
+                             "([^ \t\r\n]))", re.S)
+    _MatchWord = re.compile("[a-zA-Z0-9_\"']+")
+
+    def __call__(self, glyphs):
+        """
+        _operator()_
+
+        process a list of glyphs and convert them into
+        an Expression tree
+
+        """
+        return self.createTree(self.reduceGlyphs(glyphs))
+
+
+    def tokenize(self, expr):
+        """
+        _tokenize_
+
+        Split the expression string into glyphs, combining the
+        operator characters in pairs as ExpressionParser does.
+
+        Raises ValueError if a quoted string is not closed
+
+        """
+        glyphs = []
+        lastToken = None
+        index = 0
+        matchToken = self._MatchToken.match
+        while True:
+            match = matchToken(expr, index)
+            if match is None:
+                break
+            index = match.end()
+            kind = match.lastindex
+            token = match.group(kind)
+            if kind == 2:
+                #  //
+                # // A comment in a word is skipped up to the end
+                #//  of the line and the word goes on
+                while expr.startswith("#", index):
+                    index = self._EndOfLine(expr, index)
+                    match = self._MatchWord.match(expr, index)
+                    if match is not None:
+                        token += match.group()
+                        index = match.end()
+            elif kind == 3:
+                if token == "#":
+                    index = self._EndOfLine(expr, index)
+                    continue
+                if token in "\"'":
+                    raise ValueError, "No closing quotation"
+
+            if token in self._OperatorChars and \
+                   lastToken in self._OperatorChars:
+                glyphs[-1] = lastToken + token
+            else:
+                glyphs.append(token)
+            lastToken = token
+        return glyphs
+
+
+    def _EndOfLine(self, expr, index):
+        """
+        _EndOfLine_
+
+        Index of the character following the end of the line at index
+
+        """
+        newline = expr.find("\n", index)
+        if newline < 0:
+            return len(expr)
+        return newline + 1
+
+
+    def reduceGlyphs(self, glyphs):
+        """
+        _reduceGlyphs_
+
+        Validate the glyphs and reduce them to FunctionTerm, ValueTerm,
+        Operator objects and parentheses, the work of validateGlyphs,
+        reduceFunctions, reduceValues and reduceOperators in one loop
+
+        """
+        result = []
+        currentFunc = None
+        depth = 0
+        #  //
+        # // Unknown functions and operators are reported once the
+        #//  whole expression is validated, as GlyphParser does
+        badFunction = None
+        badOperator = None
+        for position in xrange(len(glyphs)):
+            glyph = glyphs[position]
+            if glyph == "(":
+                depth += 1
+                if currentFunc is None:
+                    result.append(glyph)
+            elif glyph == ")":
+                if depth == 0:
+                    raise IndexError, "pop from empty list"
+                depth -= 1
+                if currentFunc is None:
+                    result.append(glyph)
+                    continue
+                result.append(currentFunc)
+                try:
+                    currentFunc.loadFunction()
+                except IMProvException:
+                    if badFunction is None:
+                        badFunction = currentFunc
+                currentFunc = None
+            elif glyph in self._Operators:
+                newOp = Operator(glyph)
+                try:
+                    newOp.loadOperator()
+                except IMProvException:
+                    if badOperator is None:
+                        badOperator = newOp
+                result.append(newOp)
+            elif glyph == "[" or glyph == "]":
+                continue
+            elif self._MatchValue.match(glyph):
+                if currentFunc is None:
+                    result.append(ValueTerm(glyph))
+                else:
+                    currentFunc.appendArgument(glyph)
+            elif self._MatchFunc.match(glyph):
+                currentFunc = FunctionTerm(glyph)
+            else:
+                exprStr = "".join([" %s " % item
+                                   for item in glyphs[:position + 1]])
+                try:
+                    self.glyphType(glyph)
+                except IMProvException, ex:
+                    ex.addInfo(ErrorLocation = exprStr + "<<< Error")
+                    raise ex
+
+        if depth != 0:
+            exprStr = "".join([" %s " % item for item in glyphs])
+            msg = "Mismatched Parentheses in Predicate expression:\n"
+            msg += exprStr
+            raise IMProvException(msg, ClassInstance = self,
+                                  Expression = exprStr)
+        if badFunction is not None:
+            badFunction.loadFunction()
+        if badOperator is not None:
+            badOperator.loadOperator()
+        return result
+
+
+    def createTree(self, glyphs):
+        """
+        _createTree_
+
+        GlyphParser.createTree for the output of reduceGlyphs, where
+        the only str glyphs are the parentheses
+        """
+        result = ExprNode()
+        current = result
+        for glyph in glyphs:
+            if glyph.__class__ is str:
+                if glyph == ")":
+                    current = current.parent
+                    continue
+                newNode = ExprNode()
+                if not current.closed():
+                    current.addValue(newNode)
+                    newNode.parent = current
+                else:
+                    current.parent = newNode
+                    newNode.addValue(current)
+                current = newNode
+            elif glyph.__class__ is Operator:
+                current.operator = glyph
+                current.operatorFunction = glyph._FunctionRef
+            else:
+                current.addValue(glyph)
+        while current.parent != None:
+            current = current.parent
+        return current
+
+
+
 def parsePredicate(predicateExpr):
     """
     _parsePredicate_
@@ -537,9 +749,21 @@ def parsePredicate(predicateExpr):
     Parse, convert predicate expression string into a
     predicate object tree
     """
-    exprParser = ExpressionParser(predicateExpr)
+    if isinstance(predicateExpr, str):
+        exprParser = PredicateParser()
+        glyphParser = exprParser
+    else:
+        #  //
+        # // GlyphParser only reduces str glyphs to terms, so other
+        #//  expressions such as unicode go through the shlex parser
+        exprParser = ExpressionParser(predicateExpr)
+        glyphParser = GlyphParser()
     try:
-        glyphs = exprParser.parse()
+        if glyphParser is exprParser:
+            glyphs = exprParser.tokenize(predicateExpr)
+        else:
+            exprParser.parse()
+            glyphs = exprParser.glyphs
     except StandardError, ex:
         msg = "Error parsing predicate expression:\n"
         msg += str(predicateExpr)
@@ -547,9 +771,8 @@ def parsePredicate(predicateExpr):
         raise IMProvException(msg, ClassInstance = exprParser,
                               Expression = predicateExpr)
     
-    glyphParser = GlyphParser()
     try:
-        return glyphParser(exprParser.glyphs)
+        return glyphParser(glyphs)
     except IMProvException, ex:
         ex.addInfo(Expression = predicateExpr)
         raise ex
@@ -559,9 +782,184 @@ def parsePredicate(predicateExpr):
         msg += "Error: %s" % str(ex)
         raise IMProvException(msg, ClassInstance = glyphParser,
                               Expression = predicateExpr)
-    
 
 
 
-            
+class _NotCompilable(Exception):
+    """
+    _NotCompilable_
+
+    Raised by _compileTerm for predicate trees it does not know
+    how to compile
+
+    """
+    pass
+
+
+def compilePredicate(predicate):
+    """
+    _compilePredicate_
+
+    Turn a predicate object tree made by parsePredicate into a
+    single function of a node returning the same value.
+
+    Values are converted once, function and operator references are
+    bound, and && and || only evaluate their right hand side when the
+    left hand side does not decide the result.
+    Errors are reported with the same IMProvExceptions as the tree.
+
+    Returns the tree itself if it contains anything that cannot
+    be compiled
+
+    """
+    try:
+        return _compileTerm(predicate)
+    except _NotCompilable:
+        return predicate
+
+
+def _compileTerm(term):
+    """
+    _compileTerm_
+
+    Return the function evaluating a term of a predicate tree
+    """
+    if isinstance(term, ExprNode):
+        if term.operator == None:
+            if term.leftHandSide == None:
+                raise _NotCompilable()
+            return _compileTerm(term.leftHandSide)
+        if None in (term.leftHandSide, term.rightHandSide,
+                    term.operatorFunction):
+            raise _NotCompilable()
+        return _compileOperator(term)
+    if isinstance(term, ValueTerm):
+        value = term(None)
+        return lambda node: value
+    if isinstance(term, FunctionTerm):
+        return _compileFunction(term)
+    raise _NotCompilable()
+
+
+def _compileOperator(exprNode):
+    """
+    _compileOperator_
 
+    Return the function evaluating an ExprNode with an operator
+    """
+    left = _compileTerm(exprNode.leftHandSide)
+    right = _compileTerm(exprNode.rightHandSide)
+    function = exprNode.operatorFunction
+
+    def error(ex):
+        msg = "Error evaluating operator %s:\n" % exprNode.operator.symbol
+        msg += str(ex)
+        return IMProvException(msg, ClassInstance = exprNode)
+
+    if function is logicalAnd:
+        def evaluate(node):
+            try:
+                value = left(node)
+                if not value:
+                    return value
+                return right(node)
+            except StandardError, ex:
+                raise error(ex)
+    elif function is logicalOr:
+        def evaluate(node):
+            try:
+                value = left(node)
+                if value:
+                    return value
+                return right(node)
+            except StandardError, ex:
+                raise error(ex)
+    elif function is equalsOperator and \
+             isinstance(exprNode.rightHandSide, ValueTerm):
+        value = exprNode.rightHandSide(None)
+        def evaluate(node):
+            try:
+                return left(node) == value
+            except StandardError, ex:
+                raise error(ex)
+    else:
+        def evaluate(node):
+            try:
+                return function(left(node), right(node))
+            except StandardError, ex:
+                raise error(ex)
+    return evaluate
+
+
+def _compileFunction(functionTerm):
+    """
+    _compileFunction_
+
+    Return the function evaluating a FunctionTerm
+    """
+    function = functionTerm._FunctionRef
+    if function == None:
+        raise _NotCompilable()
+    args = tuple(functionTerm.args)
+
+    def error(ex):
+        msg = "Error evaluating function: %s\n" % functionTerm.symbol
+        msg += "With Arguments: %s\n" % ( functionTerm.args, )
+        msg += str(ex)
+        return IMProvException(msg, ClassInstance = functionTerm,
+                               PredicateFunction = functionTerm.symbol)
+
+    if len(args) == 1:
+        arg = args[0]
+        def evaluate(node):
+            try:
+                return function(node, arg)
+            except StandardError, ex:
+                raise error(ex)
+    else:
+        def evaluate(node):
+            try:
+                return function(node, *args)
+            except StandardError, ex:
+                raise error(ex)
+    return evaluate
+
+
+
+def attributeEquality(predicate):
+    """
+    _attributeEquality_
+
+    Return (attribute name, value) if the predicate object tree made
+    by parsePredicate is a single attribute("name") == value test,
+    with the value given explicitly, None otherwise.
+
+    Such predicates are True exactly for the nodes whose attribute
+    equals the value, which lets queries look them up in an index
+    """
+    expr = _unwrapTerm(predicate)
+    if not isinstance(expr, ExprNode) or \
+           expr.operatorFunction is not equalsOperator:
+        return None
+    left = _unwrapTerm(expr.leftHandSide)
+    right = _unwrapTerm(expr.rightHandSide)
+    if isinstance(left, ValueTerm):
+        left, right = right, left
+    if not isinstance(left, FunctionTerm) or \
+           not isinstance(right, ValueTerm):
+        return None
+    if left._FunctionRef is not attribute or len(left.args) != 1:
+        return None
+    return left.args[0], right(None)
+
+
+def _unwrapTerm(term):
+    """
+    _unwrapTerm_
+
+    Return the term evaluated in place of ExprNodes without an
+    operator, which evaluate their left hand side
+    """
+    while isinstance(term, ExprNode) and term.operator == None:
+        term = term.leftHandSide
+    return term
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+_LookupCache_
+
+Bounded least recently used cache for the results of
+TrivialFileCatalog path lookups.
+
+"""
+
+import threading
+from collections import OrderedDict
+
+
+#  //
+# // Marker returned by LookupCache.get when the key is not cached,
+#//  None is a valid cached value (no rule matched)
+NotCached = object()
+
+
+class LookupCache:
+    """
+    _LookupCache_
+
+    Map of key : value holding at most maxSize entries, the least
+    recently used entry is evicted when the cache is full.
+
+    Keeps count of the hits and misses seen by get
+
+    Safe to share between threads, each operation holds a lock
+
+    """
+    def __init__(self, maxSize):
+        if maxSize < 1:
+            msg = "LookupCache size must be at least 1: %s" % maxSize
+            raise ValueError, msg
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._Entries = OrderedDict()
+        self._Lock = threading.Lock()
+
+
+    def get(self, key):
+        """
+        _get_
+
+        Return the value cached for key, or NotCached
+
+        """
+        self._Lock.acquire()
+        try:
+            try:
+                value = self._Entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return NotCached
+            self._Entries[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self._Lock.release()
+
+
+    def put(self, key, value):
+        """
+        _put_
+
+        Cache value for key, evicting the least recently used
+        entry if the cache is full
+
+        """
+        self._Lock.acquire()
+        try:
+            if key in self._Entries:
+                del self._Entries[key]
+            elif len(self._Entries) >= self.maxSize:
+                self._Entries.popitem(last = False)
+            self._Entries[key] = value
+        finally:
+            self._Lock.release()
+        return
+
+
+    def clear(self):
+        """
+        _clear_
+
+        Drop all cached entries, the hit and miss counters are kept
+
+        """
+        self._Lock.acquire()
+        try:
+            self._Entries.clear()
+        finally:
+            self._Lock.release()
+        return
+
+
+    def fresh(self):
+        """
+        _fresh_
+
+        Return an empty LookupCache of the same size that carries on
+        the hit and miss counters of this one
+
+        """
+        cache = LookupCache(self.maxSize)
+        self._Lock.acquire()
+        try:
+            cache.hits = self.hits
+            cache.misses = self.misses
+        finally:
+            self._Lock.release()
+        return cache
+
+
+    def stats(self):
+        """
+        _stats_
+
+        Return a dictionary of the cache counters, read together
+        under the lock
+
+        """
+        self._Lock.acquire()
+        try:
+            return {"hits" : self.hits,
+                    "misses" : self.misses,
+                    "size" : len(self._Entries),
+                    "maxSize" : self.maxSize}
+        finally:
+            self._Lock.release()
+
+
+    def __len__(self):
+        return len(self._Entries)
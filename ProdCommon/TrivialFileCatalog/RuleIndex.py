@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+"""
+_RuleIndex_
+
+Compiled lookup structures for the rules of a TrivialFileCatalog.
+
+The rules of a catalog are bucketed by protocol and, within a protocol,
+dispatched on the literal prefix of their path-match regular expression
+so that a lookup only evaluates the regular expressions of rules that
+could possibly match the path.
+
+The order of the rules is preserved: a lookup always returns the first
+rule (in the order they were added to the catalog) that matches.
+
+Chained rules are bound to the rules of the protocol they chain to when
+the index is built, so that following a chain does not go through the
+protocol lookup again.
+
+AlternationRules is an alternative to the prefix dispatch that combines
+the expressions of all the rules of a protocol into a single regular
+expression, so that finding the first matching rule takes one scan
+whatever the literal prefixes of the rules are. It is used for the
+pfn-to-lfn rules, whose expressions often start with a wildcard.
+
+"""
+
+import re
+from itertools import izip, repeat
+
+
+#  //
+# // Characters that end the literal prefix of a regular expression
+#//
+_RegexpSpecials = ".^$*+?{}[]\\|()"
+
+#  //
+# // Inline flags such as (?i) or (?x) change the meaning of the
+#//  whole expression, so no literal prefix can be trusted
+_InlineFlags = re.compile(r"\(\?[iLmsux]+\)")
+
+#  //
+# // Constructs that cannot be moved into a combined expression:
+#//  back references, named groups, conditionals and inline flags
+_NotCombinable = re.compile(r"\\[1-9]|\(\?P|\(\?\(|\(\?[iLmsux]")
+
+#  //
+# // Limit on the number of groups in a combined expression, the
+#//  re module does not support more than 100
+_MaxGroups = 99
+
+#  //
+# // Marker returned by splitMatch when the path does not split
+#//
+NoSplit = object()
+
+
+def hasTopLevelAlternation(pattern):
+    """
+    _hasTopLevelAlternation_
+
+    Return True if the regular expression contains a | that is not
+    enclosed in a group or a character class. Unbalanced expressions
+    are reported as True so that callers stay on the safe side
+
+    """
+    depth = 0
+    index = 0
+    length = len(pattern)
+    while index < length:
+        char = pattern[index]
+        if char == "\\":
+            index += 2
+            continue
+        if char == "[":
+            #  //
+            # // Skip the character class, a ] straight after the
+            #//  opening [ or [^ is a literal
+            index += 1
+            if index < length and pattern[index] == "^":
+                index += 1
+            if index < length and pattern[index] == "]":
+                index += 1
+            while index < length and pattern[index] != "]":
+                if pattern[index] == "\\":
+                    index += 1
+                index += 1
+            if index >= length:
+                return True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                return True
+        elif char == "|" and depth == 0:
+            return True
+        index += 1
+    return depth != 0
+
+
+def literalPrefix(pattern):
+    """
+    _literalPrefix_
+
+    Return the literal string that every string matched by the
+    regular expression pattern (using re.match) must start with.
+    Returns an empty string if no such prefix can be determined
+
+    """
+    if _InlineFlags.search(pattern):
+        return ""
+    if hasTopLevelAlternation(pattern):
+        return ""
+
+    prefix = []
+    index = 0
+    length = len(pattern)
+    if pattern.startswith("^"):
+        index = 1
+    while index < length:
+        char = pattern[index]
+        width = 1
+        if char == "\\":
+            if index + 1 >= length:
+                break
+            char = pattern[index + 1]
+            if char.isalnum():
+                #  //
+                # // Character class or back reference like \d, \w, \1
+                #//
+                break
+            width = 2
+        elif char in _RegexpSpecials:
+            break
+
+        nextChar = pattern[index + width:index + width + 1]
+        if nextChar in ("*", "?", "{"):
+            #  //
+            # // Optional literal, cannot be part of the prefix
+            #//
+            break
+        prefix.append(char)
+        if nextChar == "+":
+            #  //
+            # // At least one occurence, keep it but stop here
+            #//
+            break
+        index += width
+    return "".join(prefix)
+
+
+def splitMatch(regexp, path, match = None):
+    """
+    _splitMatch_
+
+    Return the value substituted for $1 when the rule regexp is applied
+    to path, this is the same value as regexp.split(path, 1)[1] but
+    reuses the match object when one is available.
+
+    Returns NoSplit if the path does not split.
+
+    """
+    if match is not None and match.end() > 0:
+        groups = match.groups()
+        if groups:
+            return groups[0]
+        return path[match.end():]
+    #  //
+    # // Empty or missing match: let re.split deal with it
+    #//
+    try:
+        return regexp.split(path, 1)[1]
+    except IndexError:
+        return NoSplit
+
+
+class ProtocolRules:
+    """
+    _ProtocolRules_
+
+    The rules for a single protocol, indexed by the literal
+    prefix of their path-match expression.
+
+    Each rule is stored as a tuple of
+    (position, path-match-regexp, result, chain, chainRules)
+    where position is the order of the rule within the protocol and
+    chainRules the ProtocolRules of the chained protocol, set by
+    bindChains
+
+    """
+    def __init__(self):
+        self.rules = []
+        self.prefixes = {}
+        self.lengths = ()
+        #  //
+        # // Shortcut when all prefixes have the same length
+        #//
+        self._Length = 0
+        self._Table = {}
+
+
+    def addRule(self, regexp, pathMatch, result, chain):
+        """
+        _addRule_
+
+        Append a rule at the end of the rule list for this protocol
+
+        """
+        position = len(self.rules)
+        self.rules.append((position, regexp, result, chain, None))
+        prefix = literalPrefix(pathMatch)
+        table = self.prefixes.setdefault(len(prefix), {})
+        table.setdefault(prefix, []).append(position)
+        self.lengths = tuple(sorted(self.prefixes.keys()))
+        if len(self.lengths) == 1:
+            self._Length = self.lengths[0]
+            self._Table = self.prefixes[self._Length]
+        else:
+            self._Table = None
+        return
+
+
+    def bindChains(self, index):
+        """
+        _bindChains_
+
+        Set the chainRules of the chained rules from the index of
+        protocol : ProtocolRules provided. Rules chaining to a protocol
+        with no rules, or to the (empty) preferred protocol, keep None
+
+        """
+        for position, regexp, result, chain, chainRules in self.rules[:]:
+            if chain:
+                chainRules = index.get(chain, None)
+            self.rules[position] = (position, regexp, result,
+                                    chain, chainRules)
+        return
+
+
+    def candidates(self, path):
+        """
+        _candidates_
+
+        Return the positions of the rules that may match the path,
+        in rule order
+
+        """
+        found = None
+        for length in self.lengths:
+            positions = self.prefixes[length].get(path[:length])
+            if positions is None:
+                continue
+            if found is None:
+                found = positions
+            else:
+                found = sorted(set(found).union(positions))
+        if found is None:
+            return ()
+        return found
+
+
+    def match(self, path, start = 0):
+        """
+        _match_
+
+        Find the first rule at or after position start whose
+        path-match expression matches the path.
+
+        Returns a tuple of (rule, match) or None if no rule matches
+
+        """
+        if self._Table is not None:
+            positions = self._Table.get(path[:self._Length], ())
+        else:
+            positions = self.candidates(path)
+        rules = self.rules
+        for position in positions:
+            if position < start:
+                continue
+            rule = rules[position]
+            match = rule[1].match(path)
+            if match is not None:
+                return rule, match
+        return None
+
+
+    def groupMatches(self, paths, keys = None, starts = None):
+        """
+        _groupMatches_
+
+        Bulk version of match for a list of paths, identified by the
+        matching entry in keys (defaults to the index in paths) and
+        tested against rules from the matching entry in starts
+        (defaults to 0).
+
+        Returns a dictionary of position : [(key, match), ...]
+        grouping the paths by the first rule they match, the path
+        is available as match.string. Paths that do not match any
+        rule are left out
+
+        """
+        groups = {}
+        table = self._Table
+        length = self._Length
+        rules = self.rules
+        if keys is None:
+            keys = xrange(len(paths))
+        if starts is None:
+            starts = repeat(0)
+        for key, path, start in izip(keys, paths, starts):
+            if table is not None:
+                positions = table.get(path[:length], ())
+            else:
+                positions = self.candidates(path)
+            for position in positions:
+                if position < start:
+                    continue
+                match = rules[position][1].match(path)
+                if match is not None:
+                    try:
+                        groups[position].append((key, match))
+                    except KeyError:
+                        groups[position] = [(key, match)]
+                    break
+        return groups
+
+
+
+class AlternationRules(ProtocolRules):
+    """
+    _AlternationRules_
+
+    ProtocolRules matching the rules through combined regular
+    expressions of the form (pattern0)|(pattern1)|...
+
+    The alternatives of a regular expression are tried in order and the
+    first one that matches wins, just like the rules.
+    Rules whose pattern cannot be combined (see _NotCombinable) are
+    matched on their own, in sequence with the combined expressions.
+    Lookups starting after the first rule use the prefix dispatch
+
+    """
+    def __init__(self):
+        ProtocolRules.__init__(self)
+        self._Segments = None
+
+
+    def addRule(self, regexp, pathMatch, result, chain):
+        """
+        _addRule_
+
+        Append a rule at the end of the rule list for this protocol
+
+        """
+        ProtocolRules.addRule(self, regexp, pathMatch, result, chain)
+        self._Segments = None
+        return
+
+
+    def segments(self):
+        """
+        _segments_
+
+        Return the list of (regexp, position, positions) to try in turn.
+        For a combined expression, positions maps the index of the outer
+        group of each alternative to the position of its rule.
+        For the expression of a single rule, position is the position of
+        the rule and positions is None
+
+        """
+        if self._Segments is not None:
+            return self._Segments
+        segments = []
+        patterns = []
+        groups = 0
+        for position, regexp, result, chain, chainRules in self.rules:
+            pattern = regexp.pattern
+            if _NotCombinable.search(pattern) or \
+                   regexp.groups + 1 > _MaxGroups:
+                self._AddSegment(segments, patterns)
+                patterns = []
+                groups = 0
+                segments.append((regexp, position, None))
+                continue
+            if groups + regexp.groups + 1 > _MaxGroups:
+                self._AddSegment(segments, patterns)
+                patterns = []
+                groups = 0
+            patterns.append((position, regexp))
+            groups += regexp.groups + 1
+        self._AddSegment(segments, patterns)
+        self._Segments = segments
+        return segments
+
+
+    def _AddSegment(self, segments, patterns):
+        """
+        _AddSegment_
+
+        Add the combined expression for the list of (position, regexp)
+        to the segments
+
+        """
+        if len(patterns) == 0:
+            return
+        if len(patterns) == 1:
+            segments.append((patterns[0][1], patterns[0][0], None))
+            return
+        alternatives = []
+        positions = {}
+        group = 1
+        for position, regexp in patterns:
+            alternatives.append("(%s)" % regexp.pattern)
+            positions[group] = position
+            group += regexp.groups + 1
+        try:
+            combined = re.compile("|".join(alternatives))
+        except (re.error, OverflowError, AssertionError):
+            #  //
+            # // Fall back to matching the rules one by one
+            #//
+            for position, regexp in patterns:
+                segments.append((regexp, position, None))
+            return
+        segments.append((combined, None, positions))
+        return
+
+
+    def match(self, path, start = 0):
+        """
+        _match_
+
+        Find the first rule at or after position start whose
+        path-match expression matches the path.
+
+        Returns a tuple of (rule, match) or None if no rule matches
+
+        """
+        if start:
+            return ProtocolRules.match(self, path, start)
+        rules = self.rules
+        for regexp, position, positions in self._Segments or self.segments():
+            match = regexp.match(path)
+            if match is None:
+                continue
+            if positions is None:
+                return rules[position], match
+            rule = rules[positions[match.lastindex]]
+            #  //
+            # // The substitution needs the match of the rule itself
+            #//
+            return rule, rule[1].match(path)
+        return None
+
+
+    def groupMatches(self, paths, keys = None, starts = None):
+        """
+        _groupMatches_
+
+        Bulk version of match, see ProtocolRules.groupMatches
+
+        """
+        if starts is not None:
+            return ProtocolRules.groupMatches(self, paths, keys, starts)
+        groups = {}
+        match = self.match
+        if keys is None:
+            keys = xrange(len(paths))
+        for key, path in izip(keys, paths):
+            found = match(path)
+            if found is None:
+                continue
+            try:
+                groups[found[0][0]].append((key, found[1]))
+            except KeyError:
+                groups[found[0][0]] = [(key, found[1])]
+        return groups
+
+
+
+def buildRuleIndex(mappings, rulesClass = ProtocolRules):
+    """
+    _buildRuleIndex_
+
+    Build a dictionary of protocol : rulesClass instance from a list
+    of TrivialFileCatalog mapping dictionaries
+
+    """
+    index = {}
+    for mapping in mappings:
+        rules = index.get(mapping['protocol'])
+        if rules is None:
+            rules = rulesClass()
+            index[mapping['protocol']] = rules
+        rules.addRule(mapping['path-match-regexp'], mapping['path-match'],
+                      mapping['result'], mapping['chain'])
+    for rules in index.values():
+        rules.bindChains(index)
+    return index
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+_Snapshot_
+
+Precompiled snapshots of the rule tables of a TrivialFileCatalog
+XML file.
+
+A snapshot is a marshalled copy of the lfn-to-pfn and pfn-to-lfn rule
+arguments, stored in a directory owned by the caller (see
+TrivialFileCatalog.snapshotDir) under a name derived from the absolute
+path of the XML file. Nothing is written next to the XML file, which
+usually belongs to the site.
+
+A snapshot records the md5 digest of the XML content it was made from,
+and the stamp of the file when it was read: its size, modification and
+inode change times, and inode number. The inode change time cannot be
+set by hand, and changes with every write to the file:
+
+- if the stamp of the file is unchanged, and the file had not changed
+  for RacySeconds when it was read, the snapshot is used without
+  reading the XML file at all
+- otherwise, if the size is unchanged, the digest of the file is
+  computed, which costs a full read of the XML file (but no parsing),
+  and the snapshot is used if it matches. The snapshot is then
+  rewritten with the new stamp, so that the next reads skip the digest
+- a file whose size changed is parsed again
+
+A file changed less than RacySeconds before it was read may change
+again within the same tick of the file system clock without changing
+its stamp, hence the digest for such snapshots.
+
+A snapshot that cannot be read or written is ignored, the rules are
+then taken from the XML file.
+
+"""
+
+import os
+import time
+import marshal
+
+#from IMProv.IMProvUtils import fileDigest, contentDigest, writeMarshalled
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import fileDigest, contentDigest, writeMarshalled
+
+#  //
+# // Bump this when the content of the snapshot changes
+#//
+SnapshotVersion = 3
+
+#  //
+# // Granularity of file times on the coarsest file systems, see module
+#//  docs
+RacySeconds = 2
+
+
+def snapshotName(directory, filename):
+    """
+    _snapshotName_
+
+    Name of the snapshot file in directory for the TFC XML file
+    provided
+
+    """
+    path = os.path.abspath(filename)
+    return os.path.join(directory, "%s-%s.snapshot" % (
+        os.path.basename(path), contentDigest(path)))
+
+
+def fileStamp(filename):
+    """
+    _fileStamp_
+
+    Return the (size, mtime, ctime, inode) stamp of filename and
+    whether it can be trusted, that is whether the file had not changed
+    for RacySeconds, see module docs.
+
+    Take the stamp before reading the file
+
+    """
+    now = time.time()
+    stat = os.stat(filename)
+    stamp = (stat.st_size, stat.st_mtime, stat.st_ctime, stat.st_ino)
+    return stamp, max(stat.st_mtime, stat.st_ctime) < now - RacySeconds
+
+
+def readSnapshot(directory, filename):
+    """
+    _readSnapshot_
+
+    Return the (lfnToPfn, pfnToLfn) rule argument lists stored in the
+    snapshot in directory for filename, or None if there is no usable
+    snapshot
+
+    """
+    target = snapshotName(directory, filename)
+    try:
+        handle = open(target, 'rb')
+        try:
+            content = marshal.loads(handle.read())
+        finally:
+            handle.close()
+        version, path, stamp, trusted, digest, rules = content
+        if version != SnapshotVersion:
+            return None
+        if path != os.path.abspath(filename):
+            return None
+        current, currentTrusted = fileStamp(filename)
+        if trusted and current == stamp:
+            return rules
+        if current[0] != stamp[0]:
+            return None
+        if fileDigest(filename) != digest:
+            return None
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    #  //
+    # // The content is unchanged: record the new stamp
+    #//
+    if currentTrusted or current != stamp:
+        writeSnapshot(directory, filename, (current, currentTrusted),
+                      digest, rules)
+    return rules
+
+
+def writeSnapshot(directory, filename, stamp, digest, rules):
+    """
+    _writeSnapshot_
+
+    Store the (lfnToPfn, pfnToLfn) rule argument lists read from
+    filename in the snapshot in directory. stamp is the fileStamp of
+    filename taken before reading it, digest the md5 digest of the
+    content the rules were read from.
+
+    The snapshot is written to a temporary file and renamed so that
+    concurrent readers never see a partial snapshot.
+    Returns True if the snapshot was written
+
+    """
+    stamp, trusted = stamp
+    content = (SnapshotVersion, os.path.abspath(filename), stamp, trusted,
+               digest, rules)
+    return writeMarshalled(snapshotName(directory, filename), [content])
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+"""
+_TFCBenchmark_
+
+Micro-benchmarks for TrivialFileCatalog path resolution.
+
+Generates a synthetic storage.xml with the requested number of
+protocols and rules (including chained protocols) and LFN/PFN
+workloads, then measures:
+
+- load: time to load the catalog from XML and from its snapshot
+- matchLFN/matchPFN: per-lookup latency percentiles and throughput
+- matchLFNs/matchPFNs: bulk throughput
+- memory: peak resident memory of each measurement
+
+Each measurement runs in a forked process so that the memory figures
+are not polluted by the other measurements, the report is printed as
+JSON, see BenchmarkHarness.
+
+Usage:
+
+    python TFCBenchmark.py --rules=20 --paths=100000 --output=run.json
+
+"""
+
+import os
+import sys
+import time
+import random
+
+#from ProdCommon.TrivialFileCatalog.TrivialFileCatalog import TrivialFileCatalog
+#from ProdCommon.TrivialFileCatalog.Snapshot import RacySeconds
+#from IMProv.BenchmarkHarness import benchmarkParser, inChild, percentiles, runBenchmark
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.TrivialFileCatalog import TrivialFileCatalog
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.Snapshot import RacySeconds
+from PhysicsTools.HeppyCore.utils.IMProv.BenchmarkHarness import benchmarkParser, inChild, percentiles, runBenchmark
+
+
+_Namespaces = ["mc", "data", "user", "group", "temp", "unmerged",
+               "backfill", "generator", "results", "relval"]
+
+
+def generateCatalog(filename, protocols, rules, chains):
+    """
+    _generateCatalog_
+
+    Write a storage.xml with rules lfn-to-pfn and pfn-to-lfn rules for
+    each protocol in a list of protocol names, one per namespace and a
+    catch-all /store rule.
+
+    The lfn-to-pfn rules of the chains protocols after the first one
+    chain to the first protocol, like srm chaining to direct in real
+    site catalogs. Chained rules are matched against the LFN and
+    then split on the path returned by the chained protocol, so their
+    expressions accept both.
+
+    """
+    first = protocols[0]
+    lines = ["<storage-mapping>"]
+    for index, protocol in enumerate(protocols):
+        chained = index > 0 and index <= chains
+        for rule in range(rules):
+            if rule < rules - 1:
+                namespace = "%s%s/" % (_Namespaces[rule % len(_Namespaces)],
+                                       rule)
+            else:
+                namespace = ""
+            if chained:
+                lines.append(
+                    '  <lfn-to-pfn protocol="%s" chain="%s" '
+                    'path-match="/+(?:store|pool/%s)/%s(.*)" '
+                    'result="%s://se.site.org:8443/srm?SFN=/pool/%s/%s$1"/>'
+                    % (protocol, first, first, namespace, protocol,
+                       protocol, namespace))
+                lines.append(
+                    '  <pfn-to-lfn protocol="%s" '
+                    'path-match=".*\\?SFN=/pool/%s/%s(.*)" '
+                    'result="/store/%s$1"/>'
+                    % (protocol, protocol, namespace, namespace))
+                continue
+            if index == 0:
+                prefix = "/pool/%s/" % protocol
+            else:
+                prefix = "%s://se.site.org//pool/%s/" % (protocol, protocol)
+            lines.append(
+                '  <lfn-to-pfn protocol="%s" path-match="/+store/%s(.*)" '
+                'result="%s%s$1"/>' % (protocol, namespace, prefix, namespace))
+            lines.append(
+                '  <pfn-to-lfn protocol="%s" path-match="%s%s(.*)" '
+                'result="/store/%s$1"/>' % (protocol, prefix.replace(
+                "/pool", "/+pool"), namespace, namespace))
+    lines.append("</storage-mapping>")
+    handle = open(filename, 'w')
+    handle.write("\n".join(lines))
+    handle.write("\n")
+    handle.close()
+    return
+
+
+def generateLFNs(count, rules, seed):
+    """
+    _generateLFNs_
+
+    Return a list of count LFNs spread over the namespaces of the
+    generated rules
+
+    """
+    generator = random.Random(seed)
+    lfns = []
+    for index in xrange(count):
+        rule = generator.randrange(rules)
+        namespace = _Namespaces[rule % len(_Namespaces)]
+        lfns.append("/store/%s%s/Run2012%s/AOD/%08d/%d.root" % (
+            namespace, rule, "ABCD"[index % 4], generator.randrange(10**8),
+            index))
+    return lfns
+
+
+def timeLookups(function, protocol, paths):
+    """
+    _timeLookups_
+
+    Time function(protocol, path) for each path, returning latency
+    percentiles in microseconds and the overall throughput
+
+    """
+    clock = time.time
+    latencies = []
+    start = clock()
+    for path in paths:
+        before = clock()
+        function(protocol, path)
+        latencies.append(clock() - before)
+    total = clock() - start
+    latencies.sort()
+    result = percentiles([value * 1e6 for value in latencies])
+    result["lookups"] = len(paths)
+    result["seconds"] = total
+    result["lookupsPerSecond"] = len(paths) / total
+    return {"latencyMicroseconds" : result}
+
+
+def timeBulk(function, protocol, paths):
+    """
+    _timeBulk_
+
+    Time a bulk lookup function(protocol, paths)
+
+    """
+    start = time.time()
+    results = function(protocol, paths)
+    total = time.time() - start
+    return {"lookups" : len(paths), "seconds" : total,
+            "lookupsPerSecond" : len(paths) / total,
+            "matched" : len(paths) - results.count(None)}
+
+
+def benchLoad(url, repeat, snapshotDir):
+    """
+    _benchLoad_
+
+    Time loading the catalog repeat times, with snapshots in
+    snapshotDir, or without snapshots if it is None
+
+    """
+    TrivialFileCatalog.snapshotDir = snapshotDir
+    timings = []
+    for count in range(repeat):
+        start = time.time()
+        tfc = TrivialFileCatalog(url)
+        timings.append(time.time() - start)
+    timings.sort()
+    return {"rules" : len(tfc.lfnToPfn) + len(tfc.pfnToLfn),
+            "seconds" : percentiles(timings, (50,))}
+
+
+def benchLookups(url, protocol, lfns, cacheSize):
+    """
+    _benchLookups_
+
+    Time single and bulk LFN and PFN lookups on the catalog
+
+    """
+    tfc = TrivialFileCatalog(url, cacheSize = cacheSize)
+    pfns = tfc.matchLFNs(protocol, lfns)
+    pfns = [pfn for pfn in pfns if pfn is not None]
+    if cacheSize:
+        #  //
+        # // Start from an empty cache
+        #//
+        tfc.enableCache(cacheSize)
+    result = {
+        "matchLFN" : timeLookups(tfc.matchLFN, protocol, lfns),
+        "matchPFN" : timeLookups(tfc.matchPFN, protocol, pfns),
+        "matchLFNs" : timeBulk(tfc.matchLFNs, protocol, lfns),
+        "matchPFNs" : timeBulk(tfc.matchPFNs, protocol, pfns),
+        }
+    if cacheSize:
+        result["cache"] = tfc.cacheStats()
+    return result
+
+
+def benchmark(options, workDir):
+    """
+    _benchmark_
+
+    Generate the catalog in workDir and run the measurements
+
+    """
+    protocols = ["direct", "srm", "root", "gsiftp", "dcap", "rfio",
+                 "file", "xrootd"]
+    while len(protocols) < options.protocols:
+        protocols.append("proto%d" % len(protocols))
+    protocols = protocols[:options.protocols]
+
+    filename = os.path.join(workDir, "storage.xml")
+    generateCatalog(filename, protocols, options.rules, options.chains)
+    url = "trivialcatalog_file:%s?protocol=%s" % (filename, protocols[0])
+    lfns = generateLFNs(options.paths, options.rules, options.seed)
+
+    report = {
+        "parameters" : {"protocols" : options.protocols,
+                        "rules" : options.rules,
+                        "chains" : options.chains,
+                        "paths" : options.paths,
+                        "cache" : options.cache,
+                        "seed" : options.seed},
+        "loadXML" : inChild(benchLoad, url, options.repeat, None),
+        }
+    #  //
+    # // Write the snapshot once the catalog is old enough for its stamp
+    #//  to be trusted, then time loading from it
+    snapshotDir = os.path.join(workDir, "snapshots")
+    os.mkdir(snapshotDir)
+    time.sleep(RacySeconds)
+    inChild(benchLoad, url, 1, snapshotDir)
+    report["loadSnapshot"] = inChild(benchLoad, url, options.repeat,
+                                     snapshotDir)
+    for protocol in protocols[:options.chains + 1]:
+        report["lookups-%s" % protocol] = inChild(
+            benchLookups, url, protocol, lfns, options.cache)
+    return report
+
+
+def main(argv):
+    """
+    _main_
+
+    Parse the command line and run the benchmarks
+
+    """
+    parser = benchmarkParser(20, "number of catalog loads to time")
+    parser.add_option("--protocols", type = "int", default = 4,
+                      help = "number of protocols in the catalog")
+    parser.add_option("--rules", type = "int", default = 10,
+                      help = "number of rules per protocol and direction")
+    parser.add_option("--chains", type = "int", default = 1,
+                      help = "number of protocols chaining to the first one")
+    parser.add_option("--paths", type = "int", default = 100000,
+                      help = "number of paths to resolve")
+    parser.add_option("--cache", type = "int", default = 0,
+                      help = "lookup cache size (0 for no cache)")
+    options, args = parser.parse_args(argv)
+    return runBenchmark(options, "tfcbench", benchmark)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
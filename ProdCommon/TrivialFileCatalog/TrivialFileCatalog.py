@@ -30,15 +30,32 @@ Create and manipulate a trivial file catalog
 
 #from IMProv.IMProvNode import IMProvNode
 #from IMProv.IMProvQuery import IMProvQuery
-#from IMProv.IMProvLoader import loadIMProvFile
+#from IMProv.IMProvLoader import iterIMProvFile
+#from IMProv.IMProvWriter import writeIMProvFile
 #from IMProv.IMProvQuery import IMProvQuery
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvNode import IMProvNode
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvQuery import IMProvQuery
-from PhysicsTools.HeppyCore.utils.IMProv.IMProvLoader import loadIMProvFile
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvLoader import iterIMProvFile
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvWriter import writeIMProvFile
 from PhysicsTools.HeppyCore.utils.IMProv.IMProvQuery import IMProvQuery
+#from ProdCommon.TrivialFileCatalog.RuleIndex import buildRuleIndex
+#from ProdCommon.TrivialFileCatalog.RuleIndex import ProtocolRules, AlternationRules
+#from ProdCommon.TrivialFileCatalog.RuleIndex import splitMatch, NoSplit
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.RuleIndex import buildRuleIndex
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.RuleIndex import ProtocolRules, AlternationRules
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.RuleIndex import splitMatch, NoSplit
+#from ProdCommon.TrivialFileCatalog.LookupCache import LookupCache, NotCached
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.LookupCache import LookupCache, NotCached
+#from ProdCommon.TrivialFileCatalog.Snapshot import readSnapshot, writeSnapshot, fileStamp
+#from IMProv.IMProvUtils import contentDigest
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.Snapshot import readSnapshot, writeSnapshot, fileStamp
+from PhysicsTools.HeppyCore.utils.IMProv.IMProvUtils import contentDigest
 import re
 import os
 import urlparse
+import threading
+from itertools import islice
+from StringIO import StringIO
 
 _TFCArgSplit = re.compile("\?protocol=")
 
@@ -68,6 +85,83 @@ def tfcFilename(contactString):
     return path
 
 
+#  //
+# // Catalogs shared by readTFC, keyed on (filename, protocol)
+#//  holding ((mtime, size), TrivialFileCatalog)
+_TFCRegistry = {}
+_TFCRegistryLock = threading.Lock()
+
+def readTFC(contactString):
+    """
+    _readTFC_
+
+    Return the TrivialFileCatalog for a TFC contact string (or a plain
+    filename). Catalogs are shared across the process: the file is only
+    read again if its modification time or size has changed since it was
+    last loaded, so callers must not add rules to the returned instance.
+
+    Safe to call from several threads, a file is loaded by one of them
+
+    """
+    filename = tfcFilename(contactString)
+    protocol = tfcProtocol(contactString)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        msg = "TrivialFileCatalog not found: %s" % filename
+        raise RuntimeError, msg
+
+    key = (filename, protocol)
+    signature = (stat.st_mtime, stat.st_size)
+    entry = _TFCRegistry.get(key, None)
+    if entry != None and entry[0] == signature:
+        return entry[1]
+
+    _TFCRegistryLock.acquire()
+    try:
+        #  //
+        # // Another thread may have loaded it while we waited
+        #//
+        entry = _TFCRegistry.get(key, None)
+        if entry != None and entry[0] == signature:
+            return entry[1]
+        tfc = TrivialFileCatalog(contactString)
+        _TFCRegistry[key] = (signature, tfc)
+    finally:
+        _TFCRegistryLock.release()
+    return tfc
+
+
+class _ChainCycle(Exception):
+    """
+    _ChainCycle_
+
+    Raised by bulk lookups when a chain comes back to a protocol
+    whose lookup is in progress
+
+    """
+    pass
+
+
+class _RuleTable:
+    """
+    _RuleTable_
+
+    The rules of one direction (lfn-to-pfn or pfn-to-lfn) of a catalog
+    as seen by lookups: the list of mappings the table was built from
+    and its length at the time, the rule index, the preferred protocol
+    and the lookup cache (or None).
+
+    A table is never modified once published: changing the rules, the
+    preferred protocol or the cache settings publishes a new table
+
+    """
+    def __init__(self, mappings, index, preferredProtocol, cache):
+        self.mappings = mappings
+        self.length = len(mappings)
+        self.index = index
+        self.preferredProtocol = preferredProtocol
+        self.cache = cache
 
 
 class TrivialFileCatalog:
@@ -76,11 +170,45 @@ class TrivialFileCatalog:
 
     Framework Job Report container and interface object
 
+    If snapshotDir is set, the rules of the tfc files loaded are kept
+    in snapshots in that directory, and taken from them while they are
+    up to date, see Snapshot.py
+
+    If cacheSize is set, the results of matchLFN and matchPFN are kept
+    in a least recently used cache of that many entries per direction,
+    see enableCache
+
+    Lookups may run in several threads while rules are added or the
+    catalog is reloaded: each lookup uses the rule table (see _RuleTable)
+    published when it started, and never waits for a lock unless the
+    rules have just changed. Changes to the rules copy the mapping lists
+    rather than modifying them, and are serialised by a lock
+
     """
-    def __init__(self, url = None):
+    #  //
+    # // Directory to use and write snapshots of the tfc files in
+    #//  (see Snapshot.py), None not to use snapshots
+    snapshotDir = None
+
+    #  //
+    # // Lookup engines for the lfn-to-pfn and pfn-to-lfn rules,
+    #//  see RuleIndex.py
+    lfnRulesClass = ProtocolRules
+    pfnRulesClass = AlternationRules
+
+    def __init__(self, url = None, cacheSize = None):
         self.preferredProtocol = None # attribute for preferred protocol
         self.lfnToPfn = []
         self.pfnToLfn = []
+        #  //
+        # // Published rule tables, built on first lookup
+        #//
+        self._LfnTable = None
+        self._PfnTable = None
+        self._CacheSize = None
+        self._WriteLock = threading.RLock()
+        if cacheSize:
+            self.enableCache(cacheSize)
         if url:
             self.load(url)
         
@@ -90,13 +218,12 @@ class TrivialFileCatalog:
         Add a LFN-To-PFN mapping rule that will match for the given
         protocol and destination
         """
-        self.lfnToPfn.append(
-            {"protocol" : protocol,
-             "path-match" : pathMatch,
-             "path-match-regexp" : re.compile(pathMatch),
-             "chain" : chain,
-             "result" : result}
-            )
+        mapping = self._Mapping(protocol, pathMatch, result, chain)
+        self._WriteLock.acquire()
+        try:
+            self.lfnToPfn = self.lfnToPfn + [mapping]
+        finally:
+            self._WriteLock.release()
         return
 
 
@@ -109,23 +236,12 @@ class TrivialFileCatalog:
 
         Return None if no match
         """
-        if not protocol:
-            protocol = self.preferredProtocol
-            
-        for mapping in self.lfnToPfn:
-            if mapping['protocol'] != protocol:
-                continue
-            if mapping['path-match-regexp'].match(lfn):
-                if mapping['chain'] != None:
-                    lfn = self.matchLFN(mapping['chain'], lfn)
-                try:
-                    splitLFN = mapping['path-match-regexp'].split(lfn, 1)[1]
-                except IndexError:
-                    continue
-                result = mapping['result'].replace("$1", splitLFN)
-                return result
-
-        return None
+        table = self._LfnTable
+        if table is None or table.mappings is not self.lfnToPfn or \
+               table.length != len(self.lfnToPfn) or \
+               table.preferredProtocol != self.preferredProtocol:
+            table = self._LfnRules()
+        return self._Resolve(table, protocol, lfn)
 
     
     def addPfnToLfnRule(self, protocol, pathMatch, result, chain = None):
@@ -133,13 +249,12 @@ class TrivialFileCatalog:
         Add a PFN-To-LFN mapping rule that will match for the given
         protocol and destination
         """
-        self.pfnToLfn.append(
-            {"protocol" : protocol,
-             "path-match" : pathMatch,
-             "path-match-regexp" : re.compile(pathMatch),
-             "chain" : chain,
-             "result" : result}
-            )
+        mapping = self._Mapping(protocol, pathMatch, result, chain)
+        self._WriteLock.acquire()
+        try:
+            self.pfnToLfn = self.pfnToLfn + [mapping]
+        finally:
+            self._WriteLock.release()
         return
 
         
@@ -150,25 +265,429 @@ class TrivialFileCatalog:
         Return the result for the PFN provided if the LFN
         matches the path-match for that protocol
 
+        Return None if no match
+        """
+        table = self._PfnTable
+        if table is None or table.mappings is not self.pfnToLfn or \
+               table.length != len(self.pfnToLfn) or \
+               table.preferredProtocol != self.preferredProtocol:
+            table = self._PfnRules()
+        return self._Resolve(table, protocol, pfn)
+
+
+    def matchLFNs(self, protocol, lfns, stream = False, chunkSize = 10000):
+        """
+        _matchLFNs_
+
+        Bulk version of matchLFN: return the list of results for the
+        LFNs provided, in the same order, with None for LFNs that
+        do not match.
+
+        If stream is True, return a generator that consumes the LFNs
+        chunkSize at a time and yields the results as they are resolved.
+        All the LFNs are resolved against the rules as they were when
+        matchLFNs was called
+
+        """
+        table = self._LfnRules()
+        if stream:
+            return self._ResolveStream(table, protocol, lfns, chunkSize)
+        return self._ResolveBulk(table, protocol, list(lfns))
+
+
+    def matchPFNs(self, protocol, pfns, stream = False, chunkSize = 10000):
+        """
+        _matchPFNs_
+
+        Bulk version of matchPFN, see matchLFNs
+
+        """
+        table = self._PfnRules()
+        if stream:
+            return self._ResolveStream(table, protocol, pfns, chunkSize)
+        return self._ResolveBulk(table, protocol, list(pfns))
+
+
+    def enableCache(self, cacheSize):
+        """
+        _enableCache_
+
+        Keep the results of matchLFN and matchPFN, including the
+        intermediate results of chained protocols, in a least recently
+        used cache of cacheSize entries keyed on (protocol, path).
+
+        The cache is dropped whenever the rules change
+        """
+        lfnCache = LookupCache(cacheSize)
+        pfnCache = LookupCache(cacheSize)
+        self._WriteLock.acquire()
+        try:
+            self._CacheSize = cacheSize
+            self._LfnTable = self._WithCache(self._LfnTable, lfnCache)
+            self._PfnTable = self._WithCache(self._PfnTable, pfnCache)
+        finally:
+            self._WriteLock.release()
+        return
+
+
+    def disableCache(self):
+        """
+        _disableCache_
+
+        Stop caching lookup results
+        """
+        self._WriteLock.acquire()
+        try:
+            self._CacheSize = None
+            self._LfnTable = self._WithCache(self._LfnTable, None)
+            self._PfnTable = self._WithCache(self._PfnTable, None)
+        finally:
+            self._WriteLock.release()
+        return
+
+
+    def cacheStats(self):
+        """
+        _cacheStats_
+
+        Return a dictionary of lfn-to-pfn and pfn-to-lfn cache
+        statistics, or None if caching is not enabled
+        """
+        if not self._CacheSize:
+            return None
+        return {"lfn-to-pfn" : self._LfnRules().cache.stats(),
+                "pfn-to-lfn" : self._PfnRules().cache.stats()}
+
+
+    def _Mapping(self, protocol, pathMatch, result, chain):
+        """
+        _Mapping_
+
+        Make the mapping dictionary for a rule
+        """
+        return {"protocol" : protocol,
+                "path-match" : pathMatch,
+                "path-match-regexp" : re.compile(pathMatch),
+                "chain" : chain,
+                "result" : result}
+
+
+    def _LfnRules(self):
+        """
+        _LfnRules_
+
+        Return the current lfn-to-pfn rule table, publishing a new
+        one if the rules or the preferred protocol have changed
+        """
+        self._WriteLock.acquire()
+        try:
+            self._LfnTable = self._CurrentTable(
+                self._LfnTable, self.lfnToPfn, self.lfnRulesClass)
+            return self._LfnTable
+        finally:
+            self._WriteLock.release()
+
+
+    def _PfnRules(self):
+        """
+        _PfnRules_
+
+        Return the current pfn-to-lfn rule table, see _LfnRules
+        """
+        self._WriteLock.acquire()
+        try:
+            self._PfnTable = self._CurrentTable(
+                self._PfnTable, self.pfnToLfn, self.pfnRulesClass)
+            return self._PfnTable
+        finally:
+            self._WriteLock.release()
+
+
+    def _CurrentTable(self, table, mappings, rulesClass):
+        """
+        _CurrentTable_
+
+        Return table if it was built from the mappings list as it is
+        now and for the current preferred protocol, else a new table
+        using rulesClass for the rules of each protocol and an empty
+        cache. Must be called with the write lock held
+        """
+        if table is not None and table.mappings is mappings and \
+               table.length == len(mappings):
+            if table.preferredProtocol == self.preferredProtocol:
+                return table
+            #  //
+            # // Only the preferred protocol changed: keep the index
+            #//
+            index = table.index
+        else:
+            index = buildRuleIndex(mappings, rulesClass)
+        return _RuleTable(mappings, index, self.preferredProtocol,
+                          self._NewCache(table))
+
+
+    def _NewCache(self, table):
+        """
+        _NewCache_
+
+        Return an empty cache for a table replacing table, carrying on
+        the counters of its cache, or None if caching is not enabled.
+        Must be called with the write lock held
+        """
+        if not self._CacheSize:
+            return None
+        if table is not None and table.cache is not None:
+            return table.cache.fresh()
+        return LookupCache(self._CacheSize)
+
+
+    def _WithCache(self, table, cache):
+        """
+        _WithCache_
+
+        Return a copy of table (if any) using cache
+        """
+        if table is None:
+            return None
+        result = _RuleTable(table.mappings, table.index,
+                            table.preferredProtocol, cache)
+        result.length = table.length
+        return result
+
+    
+    def _Resolve(self, table, protocol, path):
+        """
+        _Resolve_
+
+        Apply the first matching rule for protocol from the rule
+        table provided to the path, following chained protocols
+        through the same table.
+        Results are looked up in and added to the cache of the
+        table if it has one
+
         Return None if no match
         """
         if not protocol:
-            protocol = self.preferredProtocol
-        
-        for mapping in self.pfnToLfn:
-            if mapping['protocol'] != protocol:
-                continue
-            if mapping['path-match-regexp'].match(pfn):
-                if mapping['chain'] != None:
-                    pfn = self.matchPFN(mapping['chain'], pfn)
-                try:
-                    splitPFN = mapping['path-match-regexp'].split(pfn, 1)[1]
-                except IndexError:
-                    continue
-                result = mapping['result'].replace("$1", splitPFN)
+            protocol = table.preferredProtocol
+        return self._ResolveRules(table, table.index.get(protocol, None),
+                                  protocol, path, ())
+
+
+    def _ResolveRules(self, table, rules, protocol, path, chained):
+        """
+        _ResolveRules_
+
+        Implementation of _Resolve given the ProtocolRules for protocol
+        (None if there are none) and the tuple of (protocol, path) chain
+        lookups in progress
+
+        """
+        cache = table.cache
+        if cache is not None:
+            key = (protocol, path)
+            result = cache.get(key)
+            if result is not NotCached:
                 return result
 
-        return None
+        if rules is None:
+            found = None
+        else:
+            found = rules.match(path)
+        while found != None:
+            (position, regexp, result, chain, chainRules), match = found
+            if chain != None:
+                path = self._Chain(table, chain, chainRules,
+                                   path, chained + ((protocol, path),))
+                value = splitMatch(regexp, path)
+            elif match.end() > 0 and regexp.groups:
+                value = match.group(1)
+            else:
+                value = splitMatch(regexp, path, match)
+            if value is not NoSplit:
+                result = result.replace("$1", value)
+                break
+            #  //
+            # // Rules after this one see the chained path
+            #//
+            found = rules.match(path, position + 1)
+        else:
+            result = None
+
+        if cache is not None:
+            cache.put(key, result)
+        return result
+
+
+    def _Chain(self, table, chain, chainRules, path, chained):
+        """
+        _Chain_
+
+        Resolve path for the chained protocol of a rule, chained is
+        the tuple of (protocol, path) lookups in progress, including
+        the one for the rule itself.
+
+        Raises RuntimeError if the chain loops back to a lookup in
+        progress or if the chained protocol has no rule for the path
+
+        """
+        if not chain:
+            chain = table.preferredProtocol
+            chainRules = table.index.get(chain, None)
+        if (chain, path) in chained:
+            msg = "TrivialFileCatalog chain loop for %s: " % path
+            msg += " -> ".join([item[0] for item in chained] + [chain])
+            raise RuntimeError, msg
+
+        result = self._ResolveRules(table, chainRules, chain, path, chained)
+        if result is None:
+            msg = "TrivialFileCatalog: no %s rule matches %s " % (chain, path)
+            msg += "for rule chained from protocol %s" % chained[-1][0]
+            raise RuntimeError, msg
+        return result
+
+
+    def _ResolveStream(self, table, protocol, paths, chunkSize):
+        """
+        _ResolveStream_
+
+        Generator resolving paths chunkSize at a time with _ResolveBulk
+
+        """
+        paths = iter(paths)
+        while True:
+            chunk = list(islice(paths, chunkSize))
+            if not chunk:
+                return
+            for result in self._ResolveBulk(table, protocol, chunk):
+                yield result
+
+
+    def _ResolveBulk(self, table, protocol, paths):
+        """
+        _ResolveBulk_
+
+        Resolve a list of paths with _ResolveMany.
+        Chains that come back to a protocol in progress may or may not
+        loop depending on the path: those are resolved path by path
+        with _Resolve, which detects the actual loops
+
+        """
+        try:
+            return self._ResolveMany(table, protocol, paths)
+        except _ChainCycle:
+            return [self._Resolve(table, protocol, path) for path in paths]
+
+
+    def _ResolveMany(self, table, protocol, paths, chained = ()):
+        """
+        _ResolveMany_
+
+        Resolve a list of paths, returning the list of results in
+        the same order.
+        chained is the tuple of protocols of the chain lookups in
+        progress
+
+        The paths are grouped by the first rule they match, chained
+        protocols are resolved once per group with a recursive bulk
+        call and the results are substituted group by group.
+        Paths that do not split after chaining go round again against
+        the following rules, as in _Resolve
+
+        """
+        if not protocol:
+            protocol = table.preferredProtocol
+        cache = table.cache
+        results = [None] * len(paths)
+
+        #  //
+        # // Keys are the indexes in paths of the paths still to be
+        #//  resolved, tested against rules from the matching start
+        keys = None
+        starts = None
+        if cache is not None:
+            keys = []
+            for item, path in enumerate(paths):
+                result = cache.get((protocol, path))
+                if result is NotCached:
+                    keys.append(item)
+                else:
+                    results[item] = result
+            resolved = keys
+            pending = [paths[item] for item in keys]
+        else:
+            pending = paths
+
+        rules = table.index.get(protocol, None)
+        if rules is None:
+            pending = []
+
+        while pending:
+            groups = rules.groupMatches(pending, keys, starts)
+            pending, keys, starts = [], [], []
+            for position, group in groups.iteritems():
+                position, regexp, result, chain, chainRules = \
+                          rules.rules[position]
+                replace = result.replace
+                if chain != None:
+                    group = [(item, m.string) for item, m in group]
+                    group = [(item, path, None) for item, path in zip(
+                        [item for item, path in group],
+                        self._ChainMany(table, protocol, chain,
+                                        chainRules, group, chained))]
+                elif regexp.groups:
+                    #  //
+                    # // Common case: substitute the first group directly
+                    #//
+                    slow = []
+                    for item, m in group:
+                        if m.end():
+                            results[item] = replace("$1", m.group(1))
+                        else:
+                            slow.append((item, m.string, m))
+                    group = slow
+                else:
+                    group = [(item, m.string, m) for item, m in group]
+                for item, path, m in group:
+                    value = splitMatch(regexp, path, m)
+                    if value is NoSplit:
+                        pending.append(path)
+                        keys.append(item)
+                        starts.append(position + 1)
+                        continue
+                    results[item] = replace("$1", value)
+
+        if cache is not None:
+            for item in resolved:
+                cache.put((protocol, paths[item]), results[item])
+        return results
+
+
+    def _ChainMany(self, table, protocol, chain, chainRules, group, chained):
+        """
+        _ChainMany_
+
+        Bulk version of _Chain for a rule of protocol, group is a list of
+        (key, path) to resolve for the chained protocol.
+        Raises _ChainCycle if the chain comes back to a protocol
+        already in progress
+
+        """
+        if not chain:
+            chain = table.preferredProtocol
+            chainRules = table.index.get(chain, None)
+        chained = chained + (protocol,)
+        if chain in chained:
+            raise _ChainCycle(chained + (chain,))
+
+        results = self._ResolveMany(table, chain,
+                                    [path for key, path in group], chained)
+        for result, (key, path) in zip(results, group):
+            if result is None:
+                msg = "TrivialFileCatalog: no %s rule matches " % chain
+                msg += "%s for rule chained from protocol %s" % (path,
+                                                                 protocol)
+                raise RuntimeError, msg
+        return results
 
 
     def save(self):
@@ -207,9 +726,7 @@ class TrivialFileCatalog:
         Write the tfc to an XML file
 
         """
-        handle = open(filename, 'w')
-        handle.write(self.save().makeDOMElement().toprettyxml())
-        handle.close()
+        writeIMProvFile(self.save(), filename)
         return
     
 
@@ -222,53 +739,93 @@ class TrivialFileCatalog:
         """
         _load_
 
-        Read a tfc into this instance
+        Read a tfc into this instance, replacing its rules.
+
+        The new rules are published at once: concurrent lookups see
+        either the old or the new catalog. If the tfc cannot be read,
+        the current rules are kept
 
         """
-        self.lfnToPfn = []
-        self.pfnToLfn = []
-        self.preferredProtocol = tfcProtocol(url)
+        preferredProtocol = tfcProtocol(url)
         filename = tfcFilename(url)
         
         if not os.path.exists(filename):
             msg = "TrivialFileCatalog not found: %s" % filename
             raise RuntimeError, msg
 
+        rules = None
+        if self.snapshotDir is not None:
+            rules = readSnapshot(self.snapshotDir, filename)
+        if rules is None:
+            rules = self._ReadRules(filename)
+
+        lfnRules, pfnRules = rules
+        lfnToPfn = [self._Mapping(*args) for args in lfnRules]
+        pfnToLfn = [self._Mapping(*args) for args in pfnRules]
+
+        #  //
+        # // Build the lookup indexes now rather than on first match
+        #//
+        lfnIndex = buildRuleIndex(lfnToPfn, self.lfnRulesClass)
+        pfnIndex = buildRuleIndex(pfnToLfn, self.pfnRulesClass)
+
+        self._WriteLock.acquire()
+        try:
+            self.preferredProtocol = preferredProtocol
+            self.lfnToPfn = lfnToPfn
+            self.pfnToLfn = pfnToLfn
+            self._LfnTable = _RuleTable(lfnToPfn, lfnIndex, preferredProtocol,
+                                        self._NewCache(self._LfnTable))
+            self._PfnTable = _RuleTable(pfnToLfn, pfnIndex, preferredProtocol,
+                                        self._NewCache(self._PfnTable))
+        finally:
+            self._WriteLock.release()
+        return
+
+
+    def _ReadRules(self, filename):
+        """
+        _ReadRules_
+
+        Parse the tfc XML file and return the lists of arguments of
+        the lfn-to-pfn and pfn-to-lfn rules it contains.
+        Store them in a snapshot of the file if snapshotDir is set
+
+        """
+        #  //
+        # // Stream the rules rather than building the whole document,
+        #//  from the content the snapshot digest is computed on
+        rules = {"lfn-to-pfn" : [], "pfn-to-lfn" : []}
         try:
-            node = loadIMProvFile(filename)
+            stamp = fileStamp(filename)
+            handle = open(filename, 'rb')
+            try:
+                content = handle.read()
+            finally:
+                handle.close()
+            digest = contentDigest(content)
+            for mapping in iterIMProvFile(StringIO(content),
+                                          "storage-mapping/*"):
+                arguments = rules.get(mapping.name, None)
+                if arguments == None:
+                    continue
+                protocol = mapping.attrs.get("protocol", None)
+                match = mapping.attrs.get("path-match", None)
+                result = mapping.attrs.get("result", None)
+                chain = mapping.attrs.get("chain", None)
+                if True in (protocol, match, mapping == None):
+                    continue
+                arguments.append((str(protocol), str(match),
+                                  str(result), chain))
         except StandardError, ex:
             msg = "Error reading TrivialFileCatalog: %s\n" % filename
             msg += str(ex)
             raise RuntimeError, msg
+        rules = [rules["lfn-to-pfn"], rules["pfn-to-lfn"]]
 
-        query = IMProvQuery("storage-mapping/lfn-to-pfn")
-        mappings = query(node)
-
-        for mapping in mappings:
-            protocol = mapping.attrs.get("protocol", None)
-            match = mapping.attrs.get("path-match", None)
-            result = mapping.attrs.get("result", None)
-            chain = mapping.attrs.get("chain", None)
-            if True in (protocol, match, mapping == None):
-                continue
-            self.addLfnToPfnRule(str(protocol), str(match), \
-                                                        str(result), chain)
-            
-        
-        query = IMProvQuery("storage-mapping/pfn-to-lfn")
-        mappings = query(node)
-
-        for mapping in mappings:
-            protocol = mapping.attrs.get("protocol", None)
-            match = mapping.attrs.get("path-match", None)
-            result = mapping.attrs.get("result", None)
-            chain = mapping.attrs.get("chain", None)
-            if True in (protocol, match, mapping == None):
-                continue
-            self.addPfnToLfnRule(str(protocol), str(match), \
-                                                        str(result), chain)
-        
-        return
+        if self.snapshotDir is not None:
+            writeSnapshot(self.snapshotDir, filename, stamp, digest, rules)
+        return rules
         
     
 
@@ -10,8 +10,8 @@ import sys
 import os
 import subprocess
 import shutil
-#from ProdCommon.TrivialFileCatalog.TrivialFileCatalog import TrivialFileCatalog
-from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.TrivialFileCatalog import TrivialFileCatalog
+#from ProdCommon.TrivialFileCatalog.TrivialFileCatalog import TrivialFileCatalog, readTFC
+from PhysicsTools.HeppyCore.utils.ProdCommon.TrivialFileCatalog.TrivialFileCatalog import TrivialFileCatalog, readTFC
 
 class cmsFileManip:
     """A class to interact with files/directories"""
@@ -328,7 +328,8 @@ def getPFN( lfn, protocol = "rfio" ):
     figure out PFN and command first
     """
 
-    tfc = TrivialFileCatalog( os.path.expandvars( "trivialcatalog_file:${CMS_PATH}/SITECONF/local/PhEDEx/storage.xml?protocol=%s" % protocol ) )
+    # the catalog is shared and only re-read when storage.xml changes
+    tfc = readTFC( os.path.expandvars( "trivialcatalog_file:${CMS_PATH}/SITECONF/local/PhEDEx/storage.xml?protocol=%s" % protocol ) )
     pfn = tfc.matchLFN( None, lfn )
     # need to hack some TURL as the TFC returns invalid ones at CERN
     if pfn.startswith( 'rfio:/castor' ):